@@ -1,8 +1,43 @@
 
-import requests
-from typing import List
-from config import LLM_API_BASE, LLM_API_KEY, LLM_MODEL_NAME, LLM_TEMPERATURE
-from database import search_chunks, get_chunk_by_id
+import argparse
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
+from typing import Callable, Iterator, List, Optional
+
+import httpx
+
+from config import (
+    LLM_API_KEY,
+    LLM_MODEL_NAME,
+    LLM_TEMPERATURE,
+    LLM_CONNECT_TIMEOUT,
+    LLM_READ_TIMEOUT,
+    LLM_MAX_CONNECTIONS,
+    LLM_MAX_KEEPALIVE_CONNECTIONS,
+    LLM_MAX_RETRIES,
+    LLM_RETRY_BACKOFF,
+    LLM_RETRY_MAX_DELAY,
+    LLM_QUEUE_TIMEOUT_SECONDS,
+    CONTEXT_TOKEN_BUDGET,
+    CONTEXT_CANDIDATES,
+    SOP_PARALLEL_SECTIONS,
+    SOP_SECTION_CONCURRENCY,
+)
+from context_packer import pack_context, count_tokens
+from vector_index import hybrid_search
+from llm_router import LLMRouter, Endpoint
+import llm_metrics
+import llm_scheduler
+import answer_cache
+
+logger = logging.getLogger(__name__)
 
 SYSTEM_PROMPT_ANSWER_ENGINE = (
     "You are a senior pharmaceutical expert. Answer questions using ONLY the "
@@ -17,35 +52,377 @@ SYSTEM_PROMPT_SOP = (
     "WHO / EU / USFDA / Schedule M expectations where applicable."
 )
 
-def _call_llm(messages: List[dict]) -> str:
-    headers = {
-        "Authorization": f"Bearer {LLM_API_KEY}",
-        "Content-Type": "application/json",
-    }
+# ==========================================================
+# HTTP CLIENT
+# ==========================================================
+# One pooled keep-alive client for the whole process, so consecutive
+# questions reuse the TCP/TLS connection to each LLM endpoint.
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+
+def get_http_client() -> httpx.Client:
+    global _http_client
+    if _http_client is None:
+        with _http_client_lock:
+            if _http_client is None:
+                _http_client = httpx.Client(
+                    timeout=httpx.Timeout(
+                        LLM_READ_TIMEOUT,
+                        connect=LLM_CONNECT_TIMEOUT,
+                    ),
+                    limits=httpx.Limits(
+                        max_connections=LLM_MAX_CONNECTIONS,
+                        max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+                    ),
+                    headers={
+                        "Authorization": f"Bearer {LLM_API_KEY}",
+                        "Content-Type": "application/json",
+                    },
+                )
+    return _http_client
+
+
+def close_http_client():
+    global _http_client
+    with _http_client_lock:
+        if _http_client is not None:
+            _http_client.close()
+            _http_client = None
+    if _router is not None:
+        _router.close()
+
+
+# The endpoint router (primary + LLM_FALLBACK_ENDPOINTS, see llm_router.py)
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_llm_router() -> LLMRouter:
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = LLMRouter.from_config()
+    return _router
+
+
+def set_llm_router(router: Optional[LLMRouter]):
+    """Swap the endpoint router (tests / stub servers). None resets it to config."""
+    global _router
+    with _router_lock:
+        if _router is not None and _router is not router:
+            _router.close()
+        _router = router
+
+
+def llm_router_stats() -> dict:
+    return get_llm_router().stats()
+
+
+def _retry_after_seconds(resp: Optional[httpx.Response]) -> Optional[float]:
+    """Parse a Retry-After header (delta-seconds or HTTP date)."""
+    if resp is None:
+        return None
+    value = resp.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def _retry_delay(attempt: int, resp: Optional[httpx.Response] = None) -> float:
+    delay = _retry_after_seconds(resp)
+    if delay is None:
+        # Exponential backoff with jitter: 1s, 2s, 4s ... (+/- 25%)
+        delay = LLM_RETRY_BACKOFF * (2 ** attempt) * random.uniform(0.75, 1.25)
+    return min(delay, LLM_RETRY_MAX_DELAY)
+
+
+def _post_with_retries(url: str, payload: dict, stream: bool = False,
+                       call: Optional[llm_metrics.LLMCall] = None,
+                       api_key: Optional[str] = None,
+                       max_retries: int = LLM_MAX_RETRIES) -> httpx.Response:
+    """POST with retries. With ``stream=True`` the body is not read and the
+    caller must close the response; retries only happen before any body
+    has been handed out. ``call`` collects connect / first-byte timings."""
+    client = get_http_client()
+    extensions = {"trace": call.trace} if call is not None else None
+    headers = {"Authorization": f"Bearer {api_key}"} if api_key else None
+    attempt = 0
+    while True:
+        resp = None
+        try:
+            request = client.build_request("POST", url, json=payload,
+                                           headers=headers, extensions=extensions)
+            resp = client.send(request, stream=stream)
+            if resp.status_code not in RETRY_STATUS_CODES:
+                if resp.is_error and stream:
+                    resp.read()
+                resp.raise_for_status()
+                return resp
+            if attempt >= max_retries:
+                if stream:
+                    resp.read()
+                resp.raise_for_status()
+            if stream:
+                resp.close()
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.ReadTimeout,
+                httpx.RemoteProtocolError) as e:
+            if attempt >= max_retries:
+                raise
+            logger.warning("LLM request failed (%s), retrying", e)
+
+        delay = _retry_delay(attempt, resp)
+        if resp is not None:
+            logger.warning("LLM returned %s, retrying in %.1fs", resp.status_code, delay)
+        time.sleep(delay)
+        attempt += 1
+
+
+def _llm_payload(messages: List[dict], stream: bool = False,
+                 model: str = LLM_MODEL_NAME) -> dict:
     payload = {
-        "model": LLM_MODEL_NAME,
+        "model": model,
         "messages": messages,
         "temperature": LLM_TEMPERATURE,
     }
-    resp = requests.post(LLM_API_BASE, json=payload, headers=headers, timeout=120)
-    resp.raise_for_status()
+    if stream:
+        payload["stream"] = True
+        payload["stream_options"] = {"include_usage": True}
+    return payload
+
+
+def _record_usage(call: Optional[llm_metrics.LLMCall], usage):
+    if call is None or not isinstance(usage, dict):
+        return
+    call.prompt_tokens = usage.get("prompt_tokens") or call.prompt_tokens
+    call.completion_tokens = usage.get("completion_tokens") or call.completion_tokens
+
+
+def _open_llm_response(messages: List[dict], stream: bool,
+                       call: Optional[llm_metrics.LLMCall] = None) -> httpx.Response:
+    """POST to the best available endpoint and return the response with
+    its body unread; the caller must close it. Endpoints that still have
+    a fallback are not retried, so failover is immediate."""
+    def send(endpoint: Endpoint, final: bool) -> httpx.Response:
+        payload = _llm_payload(messages, stream=stream, model=endpoint.model)
+        return _post_with_retries(endpoint.url, payload, stream=True, call=call,
+                                  api_key=endpoint.api_key,
+                                  max_retries=LLM_MAX_RETRIES if final else 0)
+
+    return get_llm_router().execute(send, discard=lambda resp: resp.close())
+
+
+def _call_llm(messages: List[dict], call: Optional[llm_metrics.LLMCall] = None) -> str:
+    resp = _open_llm_response(messages, stream=False, call=call)
+    try:
+        resp.read()
+    finally:
+        resp.close()
     data = resp.json()
+    _record_usage(call, data.get("usage") if isinstance(data, dict) else None)
     # Adapt depending on provider format
     try:
         return data["choices"][0]["message"]["content"]
     except Exception:
         return str(data)
 
-def answer_with_context(question: str) -> str:
-    rows = search_chunks(question, limit=5)
-    context_parts = []
-    for row in rows:
-        chunk_id = row["rowid"]
-        chunk = get_chunk_by_id(chunk_id)
-        if chunk:
-            context_parts.append(chunk["content"])
 
-    context_text = "\n\n---\n\n".join(context_parts) if context_parts else "(No specific document context found.)"
+def _stream_llm(messages: List[dict], call: Optional[llm_metrics.LLMCall] = None) -> Iterator[str]:
+    """Yield content deltas from an OpenAI-compatible SSE stream."""
+    resp = _open_llm_response(messages, stream=True, call=call)
+    try:
+        for line in resp.iter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            try:
+                event = json.loads(data)
+            except ValueError:
+                continue
+            if not isinstance(event, dict):
+                continue
+            _record_usage(call, event.get("usage"))
+            try:
+                delta = event["choices"][0]["delta"].get("content")
+            except (KeyError, IndexError, TypeError, AttributeError):
+                continue
+            if delta:
+                yield delta
+    finally:
+        resp.close()
+
+
+def _run_completion(messages: List[dict], on_delta: Optional[Callable[[str], None]] = None,
+                    entry_point: str = "other") -> str:
+    # The admission slot covers only the upstream call itself
+    asked = time.perf_counter()
+    with llm_scheduler.upstream_slot():
+        call = llm_metrics.start_call(entry_point, time.perf_counter() - asked)
+        return _timed_completion(messages, on_delta, call)
+
+
+def _timed_completion(messages: List[dict], on_delta: Optional[Callable[[str], None]],
+                      call: llm_metrics.LLMCall) -> str:
+    ok = False
+    try:
+        if on_delta is None:
+            text = _call_llm(messages, call)
+        else:
+            text = ""
+            for delta in _stream_llm(messages, call):
+                text += delta
+                on_delta(text)
+        ok = True
+        return text
+    finally:
+        # Fall back to local token counts if the provider sent no usage
+        if not call.prompt_tokens:
+            call.prompt_tokens = sum(count_tokens(str(m.get("content", ""))) for m in messages)
+        if not call.completion_tokens and ok:
+            call.completion_tokens = count_tokens(text)
+        llm_metrics.finish_call(call, ok)
+
+
+# ==========================================================
+# SINGLEFLIGHT (coalesce identical in-flight requests)
+# ==========================================================
+# When many users send the same prompt at once (e.g. after an alert),
+# only the first caller ("leader") hits the LLM; the others wait for and
+# share its result. Streaming followers receive the leader's progress.
+
+# A follower waits at most one queued, full-length upstream call for the
+# leader, then makes its own request rather than hang on a stuck leader.
+FOLLOWER_WAIT_SECONDS = LLM_QUEUE_TIMEOUT_SECONDS + LLM_CONNECT_TIMEOUT + LLM_READ_TIMEOUT
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.text = ""
+        self.result = None
+        self.error = None
+        self.listeners = []
+
+    def publish(self, text: str):
+        with self.lock:
+            self.text = text
+            listeners = list(self.listeners)
+        for listener in listeners:
+            try:
+                listener(text)
+            except Exception:
+                logger.exception("Coalesced stream listener failed")
+
+    def subscribe(self, listener: Callable[[str], None]):
+        with self.lock:
+            self.listeners.append(listener)
+            text = self.text
+        if text:
+            listener(text)
+
+    def unsubscribe(self, listener: Callable[[str], None]):
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+_flight_stats = {"leaders": 0, "coalesced": 0, "follower_timeouts": 0}
+
+_WS_RE = re.compile(r"\s+")
+
+
+def _flight_key(messages: List[dict]) -> str:
+    normalized = [
+        {"role": m.get("role"), "content": _WS_RE.sub(" ", str(m.get("content", ""))).strip()}
+        for m in messages
+    ]
+    raw = json.dumps(
+        {"model": LLM_MODEL_NAME, "temperature": LLM_TEMPERATURE, "messages": normalized},
+        sort_keys=True, ensure_ascii=False,
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def singleflight_stats() -> dict:
+    with _flights_lock:
+        stats = dict(_flight_stats)
+        stats["in_flight"] = len(_flights)
+    return stats
+
+
+def _complete(messages: List[dict], on_delta: Optional[Callable[[str], None]] = None,
+              entry_point: str = "other") -> str:
+    """Run a completion. With ``on_delta`` the answer is streamed and
+    ``on_delta`` is called with the text received so far after every
+    chunk; the full text is returned either way. Identical concurrent
+    prompts share one upstream request."""
+    key = _flight_key(messages)
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _Flight()
+            _flights[key] = flight
+            _flight_stats["leaders"] += 1
+        else:
+            _flight_stats["coalesced"] += 1
+
+    if not leader:
+        if on_delta is not None:
+            flight.subscribe(on_delta)
+        if flight.done.wait(FOLLOWER_WAIT_SECONDS):
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        if on_delta is not None:
+            flight.unsubscribe(on_delta)
+        logger.warning("Coalesced LLM request waited %ss for its leader, sending its own",
+                       FOLLOWER_WAIT_SECONDS)
+        with _flights_lock:
+            _flight_stats["follower_timeouts"] += 1
+        return _run_completion(messages, on_delta, entry_point)
+
+    if on_delta is not None:
+        flight.subscribe(on_delta)
+    try:
+        flight.result = _run_completion(
+            messages, flight.publish if on_delta is not None else None, entry_point
+        )
+        return flight.result
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with _flights_lock:
+            _flights.pop(key, None)
+        flight.done.set()
+
+
+def answer_with_context(question: str, on_delta: Optional[Callable[[str], None]] = None) -> str:
+    rows = hybrid_search(question, limit=CONTEXT_CANDIDATES)
+    context_text, chunk_ids, context_tokens = pack_context(rows, CONTEXT_TOKEN_BUDGET)
+
+    cached = answer_cache.lookup(question, chunk_ids)
+    if cached is not None:
+        return cached
+
+    if not context_text:
+        context_text = "(No specific document context found.)"
 
     messages = [
         {"role": "system", "content": SYSTEM_PROMPT_ANSWER_ENGINE},
@@ -58,18 +435,164 @@ def answer_with_context(question: str) -> str:
             ),
         },
     ]
-    return _call_llm(messages)
+    logger.info(
+        "Prompt: %d context tokens from %d/%d chunks, ~%d tokens total",
+        context_tokens, len(chunk_ids), len(rows),
+        sum(count_tokens(m["content"]) for m in messages),
+    )
+    answer = _complete(messages, on_delta, entry_point="answer")
+    answer_cache.store(question, chunk_ids, answer)
+    return answer
+
+SOP_SECTIONS = [
+    "Purpose",
+    "Scope",
+    "Responsibility",
+    "Definitions",
+    "Procedure",
+    "Precautions / Safety",
+    "Records",
+    "References",
+]
+
+
+def generate_sop(topic: str, extra_details: str = "",
+                 on_delta: Optional[Callable[[str], None]] = None,
+                 on_section: Optional[Callable[[int, str], None]] = None) -> str:
+    """Draft an SOP. ``on_section(number, text)`` is only used in parallel
+    section mode (SOP_PARALLEL_SECTIONS)."""
+    if SOP_PARALLEL_SECTIONS:
+        return generate_sop_sections(topic, extra_details, on_delta, on_section)
 
-def generate_sop(topic: str, extra_details: str = "") -> str:
     user_prompt = (
         f"Draft a detailed SOP for: {topic}.\n"
         f"Additional details: {extra_details}\n\n"
         "Structure with the following sections where applicable: "
-        "1. Purpose 2. Scope 3. Responsibility 4. Definitions 5. Procedure "
-        "6. Precautions / Safety 7. Records 8. References."
+        + " ".join(f"{i}. {s}" for i, s in enumerate(SOP_SECTIONS, start=1)) + "."
+    )
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT_SOP},
+        {"role": "user", "content": user_prompt},
+    ]
+    return _complete(messages, on_delta, entry_point="sop")
+
+
+def _sop_outline(topic: str, extra_details: str) -> str:
+    user_prompt = (
+        f"Plan an SOP for: {topic}.\n"
+        f"Additional details: {extra_details}\n\n"
+        "Give only a compact outline: for each section below, 2-4 short "
+        "bullet points naming what it must cover. No prose.\n"
+        + "\n".join(f"{i}. {s}" for i, s in enumerate(SOP_SECTIONS, start=1))
+    )
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT_SOP},
+        {"role": "user", "content": user_prompt},
+    ]
+    return _complete(messages, entry_point="sop_outline")
+
+
+def _sop_section(topic: str, extra_details: str, outline: str, number: int) -> str:
+    section = SOP_SECTIONS[number - 1]
+    user_prompt = (
+        f"We are drafting an SOP for: {topic}.\n"
+        f"Additional details: {extra_details}\n\n"
+        f"Agreed outline of the whole SOP:\n{outline}\n\n"
+        f"Write ONLY section {number}. {section}, in full, following the outline. "
+        f"Start with the heading \"{number}. {section}\". Do not write any other "
+        "section and do not add an introduction or closing remarks."
     )
     messages = [
         {"role": "system", "content": SYSTEM_PROMPT_SOP},
         {"role": "user", "content": user_prompt},
     ]
-    return _call_llm(messages)
+    return _complete(messages, entry_point="sop_section").strip()
+
+
+def generate_sop_sections(topic: str, extra_details: str = "",
+                          on_delta: Optional[Callable[[str], None]] = None,
+                          on_section: Optional[Callable[[int, str], None]] = None) -> str:
+    """SOP built from one outline call plus one call per section, with
+    the sections requested concurrently, so wall-clock time is roughly
+    outline + slowest section. Every call takes its own admission slot
+    (llm_scheduler), so one SOP never exceeds LLM_MAX_CONCURRENCY.
+
+    Sections are released in order as soon as all earlier ones are done:
+    ``on_section(number, text)`` is called once per section and
+    ``on_delta`` gets the SOP assembled so far.
+    """
+    outline = _sop_outline(topic, extra_details)
+    sections = [None] * len(SOP_SECTIONS)
+    released = 0
+
+    # Section threads inherit the user's metrics attribution and priority
+    section_call = llm_metrics.propagate(_sop_section)
+    workers = min(SOP_SECTION_CONCURRENCY, llm_scheduler.scheduler.max_concurrency)
+    with ThreadPoolExecutor(max_workers=workers,
+                            thread_name_prefix="sop-section") as pool:
+        futures = {
+            pool.submit(section_call, topic, extra_details, outline, number): number
+            for number in range(1, len(SOP_SECTIONS) + 1)
+        }
+        try:
+            for future in as_completed(futures):
+                sections[futures[future] - 1] = future.result()
+                while released < len(sections) and sections[released] is not None:
+                    released += 1
+                    if on_section is not None:
+                        on_section(released, sections[released - 1])
+                    if on_delta is not None:
+                        on_delta("\n\n".join(sections[:released]))
+        except Exception:
+            for future in futures:
+                future.cancel()
+            raise
+    return "\n\n".join(sections)
+
+
+# ==========================================================
+# STUB-SERVER SELF-TEST
+# ==========================================================
+def selftest(calls: int = 5):
+    """Keep-alive reuse and the retry path of the pooled HTTP client,
+    against a local stub server (see llm_router._stub_server)."""
+    from llm_router import _stub_server
+
+    messages = [{"role": "user", "content": "ping"}]
+    server, handler, url = _stub_server(script=[
+        (503, {}),
+        (429, {"Retry-After": "1"}),
+    ])
+    try:
+        set_llm_router(LLMRouter([Endpoint("stub", url, "test", "stub")], hedge=False))
+
+        started = time.perf_counter()
+        text = _run_completion(messages, entry_point="selftest")
+        elapsed = time.perf_counter() - started
+        assert text == "answer from stub", text
+        assert handler.hits == 3, handler.hits
+        assert elapsed >= 1.0, elapsed    # honoured Retry-After
+        print(f"503 -> 429 (Retry-After: 1) -> 200: answered after {handler.hits} attempts"
+              f" in {elapsed:.1f}s")
+
+        handler.ports.clear()
+        for _ in range(calls):
+            _run_completion(messages, entry_point="selftest")
+        assert len(set(handler.ports)) == 1, handler.ports
+        print(f"{calls} calls reused one connection (client port {handler.ports[0]})")
+    finally:
+        server.shutdown()
+        close_http_client()
+        set_llm_router(None)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
+    parser = argparse.ArgumentParser(description="LLM client")
+    parser.add_argument("--selftest", action="store_true",
+                        help="check connection reuse and retries against a stub server")
+    args = parser.parse_args()
+    if args.selftest:
+        selftest()
+    else:
+        parser.print_help()
@@ -0,0 +1,81 @@
+import hashlib
+import re
+import threading
+from typing import Iterable, Optional
+
+from config import (
+    ANSWER_CACHE_ENABLED,
+    ANSWER_CACHE_TTL_SECONDS,
+    ANSWER_CACHE_MAX_ENTRIES,
+    LLM_MODEL_NAME,
+)
+from database import (
+    get_cached_answer,
+    put_cached_answer,
+    purge_expired_answers,
+    answer_cache_summary,
+)
+
+# Bump when the answer prompt changes so old answers stop matching
+PROMPT_VERSION = "2"
+
+_stats = {"hits": 0, "misses": 0, "stores": 0}
+_stats_lock = threading.Lock()
+
+_WS_RE = re.compile(r"\s+")
+
+
+def normalize_question(question: str) -> str:
+    """Lower-case, collapse whitespace and drop trailing punctuation."""
+    text = _WS_RE.sub(" ", (question or "").strip().lower())
+    return text.rstrip(" ?!.")
+
+
+def make_key(question: str, chunk_ids: Iterable[int]) -> str:
+    parts = [
+        PROMPT_VERSION,
+        LLM_MODEL_NAME,
+        normalize_question(question),
+        ",".join(str(i) for i in chunk_ids),
+    ]
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+def _bump(key: str):
+    with _stats_lock:
+        _stats[key] += 1
+
+
+def lookup(question: str, chunk_ids) -> Optional[str]:
+    if not ANSWER_CACHE_ENABLED:
+        return None
+    answer = get_cached_answer(make_key(question, chunk_ids), ANSWER_CACHE_TTL_SECONDS)
+    _bump("hits" if answer is not None else "misses")
+    return answer
+
+
+def store(question: str, chunk_ids, answer: str):
+    if not ANSWER_CACHE_ENABLED or not answer:
+        return
+    put_cached_answer(
+        make_key(question, chunk_ids),
+        normalize_question(question),
+        list(chunk_ids),
+        answer,
+        ANSWER_CACHE_MAX_ENTRIES,
+    )
+    _bump("stores")
+
+
+def purge_expired() -> int:
+    return purge_expired_answers(ANSWER_CACHE_TTL_SECONDS)
+
+
+def stats() -> dict:
+    """Hit/miss counters since start plus what is stored in the DB."""
+    with _stats_lock:
+        result = dict(_stats)
+    lookups = result["hits"] + result["misses"]
+    result["hit_rate"] = (result["hits"] / lookups) if lookups else 0.0
+    result.update(answer_cache_summary())
+    return result
@@ -1,5 +1,8 @@
 import logging
 import os
+import tempfile
+import time
+from contextlib import contextmanager
 from functools import wraps
 from io import BytesIO
 
@@ -7,6 +10,7 @@ from telegram import (
     Update,
     ReplyKeyboardMarkup,
 )
+from telegram.error import TelegramError
 from telegram.ext import (
     Updater,
     CommandHandler,
@@ -15,25 +19,56 @@ from telegram.ext import (
     CallbackContext,
 )
 
-from config import TELEGRAM_BOT_TOKEN, ADMIN_IDS, BOOKS_FOLDER, PENDING_PDFS_FOLDER, BOT_NAME
+from config import (
+    TELEGRAM_BOT_TOKEN,
+    ADMIN_IDS,
+    BOOKS_FOLDER,
+    PENDING_PDFS_FOLDER,
+    BOT_NAME,
+    LLM_STREAMING,
+    STREAM_EDIT_INTERVAL_SECONDS,
+    STREAM_EDIT_MIN_CHARS,
+    SOP_PARALLEL_SECTIONS,
+)
 from database import (
     init_db,
+    close_all_connections,
+    start_last_seen_flusher,
+    stop_last_seen_flusher,
+    flush_last_seen,
+    start_message_writer,
+    stop_message_writer,
     get_or_create_user,
     get_user_by_chat_id,
     save_message,
     list_pending_documents,
-    insert_document,
     get_document,
     set_user_premium,
     set_user_admin,
     list_users_by_premium,
     list_online_users,
+    count_users_by_premium,
+    count_online_users,
+    iter_pages,
+)
+from subscription import reserve_message, refund_message, subscription_status_text
+from ai_engine import (
+    answer_with_context,
+    generate_sop,
+    close_http_client,
+    singleflight_stats,
+    llm_router_stats,
 )
-from subscription import can_user_ask, consume_message, subscription_status_text
-from ai_engine import answer_with_context, generate_sop
 from regulatory_alerts import get_latest_alerts
 from voice_handler import transcribe_voice
-from pdf_approval import save_pending_pdf, approve_pending_pdf
+from pdf_approval import HashingWriter, register_upload, backfill_document_hashes, prefetch_pending
+from extract_cache import stop_prefetch
+from ingest_jobs import enqueue_pdf_approval, start_ingest_worker, stop_ingest_worker
+from maintenance import start_maintenance_scheduler, stop_maintenance_scheduler
+from vector_index import start_index_build
+from llm_scheduler import admission as llm_admission, RateLimited, QueueTimeout
+import answer_cache
+import llm_metrics
 
 # ==========================================================
 # IMPORT CONVERSATION HANDLERS (MOA / DEVIATION / CAPA / CC / ARTWORK)
@@ -112,9 +147,11 @@ ADMIN_MENU = [
 # ADMIN HELPERS
 # ==========================================================
 def _is_admin_user(chat_id: int) -> bool:
+    if chat_id in ADMIN_IDS:
+        return True
+    # Served from database's user cache after the first lookup
     db_user = get_user_by_chat_id(chat_id)
-    db_flag = bool(db_user and db_user["is_admin"])
-    return (chat_id in ADMIN_IDS) or db_flag
+    return bool(db_user and db_user["is_admin"])
 
 
 def admin_only(func):
@@ -312,9 +349,158 @@ def _handle_menu_buttons(update: Update, context: CallbackContext) -> bool:
     return False
 
 
+# ==========================================================
+# LLM REPLIES (plain + streamed)
+# ==========================================================
+REPLY_MAX_CHARS = 3500      # above this the answer goes out as answer.txt
+REPLY_PREVIEW_CHARS = 3000
+
+
+def _send_long_reply(message, reply: str, edit_target=None):
+    """Send reply, or a preview plus answer.txt if it is too long for one message.
+
+    With ``edit_target`` the text is written into that (placeholder)
+    message instead of a new one.
+    """
+    send = edit_target.edit_text if edit_target else message.reply_text
+    if len(reply) > REPLY_MAX_CHARS:
+        send(reply[:REPLY_PREVIEW_CHARS] + "\n\n[Full answer attached]")
+
+        bio = BytesIO(reply.encode("utf-8"))
+        bio.name = "answer.txt"
+        message.reply_document(bio, filename=bio.name)
+    else:
+        send(reply or "(empty answer)")
+
+
+class StreamingReply:
+    """Placeholder message that is progressively edited as tokens arrive.
+
+    Edits are throttled to one per STREAM_EDIT_INTERVAL_SECONDS and only
+    when at least STREAM_EDIT_MIN_CHARS new characters arrived. Once the
+    text outgrows one message the preview stops updating and finish()
+    falls back to the answer.txt attachment.
+    """
+
+    def __init__(self, message):
+        self.message = message
+        self.placeholder = message.reply_text("⏳ Thinking…")
+        self._last_edit = 0.0   # first tokens are shown immediately
+        self._last_len = 0
+        self._overflowed = False
+
+    def _edit(self, text: str):
+        try:
+            self.placeholder.edit_text(text)
+        except TelegramError as e:
+            # A failed progress edit must not abort the LLM stream
+            if "not modified" not in str(e).lower():
+                logger.warning("Failed to edit streamed reply: %s", e)
+
+    def update(self, text: str):
+        if self._overflowed:
+            return
+        if len(text) > REPLY_MAX_CHARS:
+            self._overflowed = True
+            self._edit(text[:REPLY_PREVIEW_CHARS] + "\n\n…")
+            return
+
+        now = time.monotonic()
+        if now - self._last_edit < STREAM_EDIT_INTERVAL_SECONDS:
+            return
+        if len(text) - self._last_len < STREAM_EDIT_MIN_CHARS:
+            return
+        self._last_edit = now
+        self._last_len = len(text)
+        self._edit(text + " ▌")
+
+    def finish(self, reply: str):
+        _send_long_reply(self.message, reply, edit_target=self.placeholder)
+
+    def fail(self, text: str):
+        self._edit(text)
+
+    def status(self, text: str):
+        """Replace the placeholder text while no answer has arrived yet."""
+        if self._last_len == 0:
+            self._edit(text)
+
+
+class SectionReply:
+    """Multi-part answer (a parallel SOP) sent one section per message as
+    sections become ready. Same interface as StreamingReply."""
+
+    def __init__(self, message):
+        self.message = message
+        self.placeholder = message.reply_text("⏳ Drafting SOP outline…")
+        self.sent = 0
+
+    def section(self, number: int, text: str):
+        edit_target = self.placeholder if self.sent == 0 else None
+        try:
+            _send_long_reply(self.message, text, edit_target=edit_target)
+        except TelegramError as e:
+            logger.warning("Failed to send SOP section %d: %s", number, e)
+        self.sent += 1
+
+    def update(self, text: str):
+        pass
+
+    def finish(self, reply: str):
+        if self.sent == 0:
+            _send_long_reply(self.message, reply, edit_target=self.placeholder)
+
+    def _send(self, text: str, edit: bool):
+        try:
+            if edit:
+                self.placeholder.edit_text(text)
+            else:
+                self.message.reply_text(text)
+        except TelegramError as e:
+            if "not modified" not in str(e).lower():
+                logger.warning("Failed to update SOP reply: %s", e)
+
+    def fail(self, text: str):
+        self._send(text, edit=self.sent == 0)
+
+    def status(self, text: str):
+        if self.sent == 0:
+            self._send(text, edit=True)
+
+
+def _queue_notifier(message, stream: "StreamingReply" = None):
+    """Callback for llm_scheduler: tell the user their queue position."""
+    def notify(position: int):
+        text = f"⏳ Busy right now, you are #{position} in the queue…"
+        if stream:
+            stream.status(text)
+        elif position and not notify.sent:
+            notify.sent = True
+            message.reply_text(text)
+    notify.sent = False
+    return notify
+
+
+def _llm_busy_text(e: Exception) -> str:
+    if isinstance(e, RateLimited):
+        return f"You are sending questions too fast. Please try again in {e.retry_after:.0f}s."
+    return "The assistant is busy right now. Please try again in a minute."
+
+
 # ==========================================================
 # MAIN TEXT HANDLER (Q&A + SOP)
 # ==========================================================
+@contextmanager
+def _llm_admission(user, db_user, on_queued=None):
+    """Admit one LLM-backed reply (charges the user's rate limit). Upstream
+    calls made inside queue for a slot with the user's priority and are
+    attributed to the user in llm_metrics; cache hits and coalesced
+    requests never take a slot."""
+    with llm_metrics.request_context(db_user["id"]):
+        with llm_admission(user.id, bool(db_user["is_premium"]), on_queued=on_queued):
+            yield
+
+
 def text_message(update: Update, context: CallbackContext):
     user = update.effective_user
     message_text = (update.message.text or "").strip()
@@ -338,10 +524,10 @@ def text_message(update: Update, context: CallbackContext):
         if admin_mode == "approve_pdf_id":
             try:
                 doc_id = int(message_text)
-                ok, msg = approve_pending_pdf(doc_id, user.id)
-                update.message.reply_text(msg)
             except Exception:
                 update.message.reply_text("Invalid PDF ID.")
+            else:
+                _queue_pdf_approval(update, doc_id)
             ADMIN_EXPECT.pop(user.id, None)
             return
 
@@ -361,32 +547,58 @@ def text_message(update: Update, context: CallbackContext):
 
     # 4) Main Q&A / SOP engine
     db_user = get_or_create_user(user.id, user.username, user.full_name)
-    allowed, msg = can_user_ask(db_user)
+    allowed, msg = reserve_message(db_user)
     if not allowed:
         update.message.reply_markdown(msg)
         return
 
     mode = USER_MODE.get(user.id, "ask")
+    try:
+        if mode == "sop" and SOP_PARALLEL_SECTIONS:
+            stream = SectionReply(update.message)
+        else:
+            stream = StreamingReply(update.message) if LLM_STREAMING else None
+    except TelegramError:
+        # Nothing was answered, so the reserved message goes back
+        refund_message(db_user)
+        logger.exception("Failed to send reply placeholder")
+        return
+    on_delta = stream.update if stream else None
 
     try:
-        if mode == "sop":
-            reply = generate_sop(message_text)
+        with _llm_admission(user, db_user, _queue_notifier(update.message, stream)):
+            if mode == "sop":
+                reply = generate_sop(
+                    message_text,
+                    on_delta=on_delta,
+                    on_section=stream.section if isinstance(stream, SectionReply) else None,
+                )
+            else:
+                reply = answer_with_context(message_text, on_delta=on_delta)
+    except (RateLimited, QueueTimeout) as e:
+        refund_message(db_user)
+        if stream:
+            stream.fail(_llm_busy_text(e))
         else:
-            reply = answer_with_context(message_text)
+            update.message.reply_text(_llm_busy_text(e))
+        return
+    except Exception as e:
+        refund_message(db_user)
+        logger.exception("Error in text_message")
+        if stream:
+            stream.fail(f"Error: {e}")
+        else:
+            update.message.reply_text(f"Error: {e}")
+        return
 
-        consume_message(db_user)
+    try:
         save_message(db_user["id"], "user", message_text)
         save_message(db_user["id"], "assistant", reply)
 
-        if len(reply) > 3500:
-            short = reply[:3000] + "\n\n[Full answer attached]"
-            update.message.reply_text(short)
-
-            bio = BytesIO(reply.encode("utf-8"))
-            bio.name = "answer.txt"
-            update.message.reply_document(bio, filename=bio.name)
+        if stream:
+            stream.finish(reply)
         else:
-            update.message.reply_text(reply)
+            _send_long_reply(update.message, reply)
 
     except Exception as e:
         logger.exception("Error in text_message")
@@ -412,16 +624,17 @@ def document_handler(update: Update, context: CallbackContext):
     file = doc.get_file()
     os.makedirs(PENDING_PDFS_FOLDER, exist_ok=True)
     tmp_path = os.path.join(PENDING_PDFS_FOLDER, f"tmp_{doc.file_unique_id}.pdf")
-    file.download(tmp_path)
-
-    final_path = save_pending_pdf(tmp_path, doc.file_name)
-    doc_id = insert_document(
-        title=doc.file_name,
-        filename=os.path.basename(final_path),
-        pages=0,
-        uploaded_by_user_id=db_user["id"],
-        status="pending",
-    )
+    with HashingWriter(tmp_path) as out:
+        file.download(out=out)
+
+    doc_id, original = register_upload(tmp_path, doc.file_name, out.hexdigest(), db_user["id"])
+    if original is not None:
+        state = "approved" if original["status"] == "approved" else "awaiting approval"
+        update.message.reply_text(
+            f"This PDF is already in the library as \"{original['title']}\" "
+            f"(ID {original['id']}, {state}), so it was not stored again."
+        )
+        return
 
     update.message.reply_text(
         f"Your PDF is saved with ID *{doc_id}* and sent to admin.",
@@ -445,29 +658,44 @@ def voice_handler(update: Update, context: CallbackContext):
     user = update.effective_user
     db_user = get_or_create_user(user.id, user.username, user.full_name)
 
-    allowed, msg = can_user_ask(db_user)
+    allowed, msg = reserve_message(db_user)
     if not allowed:
         update.message.reply_markdown(msg)
         return
 
     voice = update.message.voice or update.message.audio
     if not voice:
+        refund_message(db_user)
         update.message.reply_text("No audio found.")
         return
 
-    file = voice.get_file()
-    os.makedirs("tmp_voice", exist_ok=True)
-    path = os.path.join("tmp_voice", f"{voice.file_unique_id}.ogg")
-    file.download(path)
-
-    text = transcribe_voice(path)
+    try:
+        file = voice.get_file()
+        os.makedirs("tmp_voice", exist_ok=True)
+        path = os.path.join("tmp_voice", f"{voice.file_unique_id}.ogg")
+        file.download(path)
+        text = transcribe_voice(path)
+    except Exception:
+        logger.exception("Failed to download or transcribe voice message")
+        text = None
     if not text:
+        refund_message(db_user)
         update.message.reply_text("Failed to transcribe audio.")
         return
 
     try:
-        reply = answer_with_context(text)
-        consume_message(db_user)
+        with _llm_admission(user, db_user, _queue_notifier(update.message)):
+            reply = answer_with_context(text)
+    except (RateLimited, QueueTimeout) as e:
+        refund_message(db_user)
+        update.message.reply_text(_llm_busy_text(e))
+        return
+    except Exception as e:
+        refund_message(db_user)
+        update.message.reply_text(f"Error: {e}")
+        return
+
+    try:
         save_message(db_user["id"], "user", f"[voice] {text}")
         save_message(db_user["id"], "assistant", reply)
 
@@ -541,8 +769,35 @@ def approve_pdf_cmd(update: Update, context: CallbackContext):
         update.message.reply_text("Invalid ID.")
         return
 
-    ok, msg = approve_pending_pdf(doc_id, update.effective_user.id)
-    update.message.reply_text(msg)
+    _queue_pdf_approval(update, doc_id)
+
+
+def _queue_pdf_approval(update: Update, doc_id: int):
+    """Queue background ingestion; the worker edits this status message."""
+    status = update.message.reply_text(f"⏳ PDF {doc_id} queued for ingestion…")
+    ok, msg = enqueue_pdf_approval(doc_id, update.effective_user.id,
+                                   status.chat_id, status.message_id)
+    if not ok:
+        status.edit_text(msg)
+
+
+def _ingest_notifier(bot):
+    """Progress callback for ingest_jobs: edit the admin's status message."""
+    def notify(job, text: str, final: bool):
+        if not job["chat_id"]:
+            return
+        try:
+            bot.edit_message_text(text, chat_id=job["chat_id"],
+                                  message_id=job["status_message_id"])
+        except TelegramError as e:
+            if "not modified" in str(e).lower():
+                return
+            if not final:
+                logger.warning("Failed to edit ingestion status: %s", e)
+                return
+            # The status message is gone; make sure the result still arrives
+            bot.send_message(job["chat_id"], text)
+    return notify
 
 
 # ==========================================================
@@ -581,58 +836,113 @@ def add_admin_cmd(update: Update, context: CallbackContext):
 
 @admin_only
 def admin_online_users_cmd(update: Update, context: CallbackContext):
-    rows = list_online_users(minutes=15)
-    update.message.reply_text(f"Online users: {len(rows)}")
+    flush_last_seen()
+    total = count_online_users(minutes=15)
+    update.message.reply_text(f"Online users: {total}")
 
-    if rows:
-        _send_users_as_html(update, "Online Users (15 min)", rows)
+    if total:
+        _send_users_as_html(update, "Online Users (15 min)", iter_pages(list_online_users, 15))
 
 
 @admin_only
 def admin_subscribed_users_cmd(update: Update, context: CallbackContext):
-    rows = list_users_by_premium(1)
-    update.message.reply_text(f"Premium users: {len(rows)}")
-    if rows:
-        _send_users_as_html(update, "Premium Users", rows)
+    total = count_users_by_premium(1)
+    update.message.reply_text(f"Premium users: {total}")
+    if total:
+        _send_users_as_html(update, "Premium Users", iter_pages(list_users_by_premium, 1))
 
 
 @admin_only
 def admin_free_users_cmd(update: Update, context: CallbackContext):
-    rows = list_users_by_premium(0)
-    update.message.reply_text(f"Free users: {len(rows)}")
-    if rows:
-        _send_users_as_html(update, "Free Users", rows)
+    total = count_users_by_premium(0)
+    update.message.reply_text(f"Free users: {total}")
+    if total:
+        _send_users_as_html(update, "Free Users", iter_pages(list_users_by_premium, 0))
+
+
+@admin_only
+def cache_stats_cmd(update: Update, context: CallbackContext):
+    s = answer_cache.stats()
+    f = singleflight_stats()
+    update.message.reply_text(
+        "Answer cache:\n"
+        f"Hits: {s['hits']}\n"
+        f"Misses: {s['misses']}\n"
+        f"Hit rate: {s['hit_rate']:.1%}\n"
+        f"Stored answers: {s['entries']} (lifetime hits {s['stored_hits']})\n\n"
+        "In-flight coalescing:\n"
+        f"Upstream calls: {f['leaders']}\n"
+        f"Coalesced calls: {f['coalesced']}\n"
+        f"Gave up waiting for leader: {f['follower_timeouts']}\n"
+        f"In flight now: {f['in_flight']}"
+    )
+
+
+@admin_only
+def llm_stats_cmd(update: Update, context: CallbackContext):
+    summary = llm_metrics.latency_summary()
+    lines = ["LLM latency since start (ms):"]
+    for name, label in (("total_ms", "Total"), ("ttfb_ms", "First byte"),
+                        ("queue_wait_ms", "Queue wait"), ("connect_ms", "Connect")):
+        s = summary[name]
+        lines.append(f"{label}: p50 {s['p50']:.0f} / p95 {s['p95']:.0f} / p99 {s['p99']:.0f}"
+                     f" (n={s['count']})")
+    for entry, s in sorted(summary["by_entry_point"].items()):
+        lines.append(f"  {entry}: p50 {s['p50']:.0f} / p95 {s['p95']:.0f} (n={s['count']})")
+
+    router = llm_router_stats()
+    lines.append("")
+    lines.append(f"Endpoints ({router['failovers']} failovers, {router['hedged']} hedged,"
+                 f" {router['hedge_wins']} won by hedge):")
+    for e in router["endpoints"]:
+        p95 = f"{e['p95_ms']:.0f} ms" if e["p95_ms"] is not None else "n/a"
+        state = f"cooldown {e['cooldown_s']:.0f}s" if e["cooldown_s"] else "ok"
+        lines.append(f"{e['name']}: {e['requests']} calls, {e['error_rate']:.0%} errors,"
+                     f" p95 {p95}, {state}")
+
+    lines.append("")
+    lines.append("Top token users today (UTC):")
+    consumers = llm_metrics.top_consumers(days=1, limit=10)
+    if not consumers:
+        lines.append("No usage recorded yet.")
+    for c in consumers:
+        who = c["username"] or c["full_name"] or c["chat_id"] or "unknown"
+        lines.append(
+            f"{who}: {c['calls']} calls, {c['prompt_tokens']}+{c['completion_tokens']} tokens,"
+            f" ${c['cost_usd']:.4f}"
+        )
+    update.message.reply_text("\n".join(lines))
 
 
 # ==========================================================
 # HTML REPORT TABLE GENERATOR
 # ==========================================================
 def _send_users_as_html(update: Update, title: str, rows):
-    html = [
-        "<html><body>",
-        f"<h2>{title}</h2>",
-        "<table border='1' cellspacing='0' cellpadding='4'>",
-        "<tr><th>ID</th><th>Chat ID</th><th>Username</th><th>Name</th>"
-        "<th>Premium</th><th>Admin</th><th>Last Seen</th></tr>",
-    ]
-    for u in rows:
-        html.append(
-            "<tr>"
-            f"<td>{u['id']}</td>"
-            f"<td>{u['chat_id']}</td>"
-            f"<td>{u['username'] or ''}</td>"
-            f"<td>{u['full_name'] or ''}</td>"
-            f"<td>{'Yes' if u['is_premium'] else 'No'}</td>"
-            f"<td>{'Yes' if u['is_admin'] else 'No'}</td>"
-            f"<td>{u['last_seen']}</td>"
-            "</tr>"
-        )
-    html.append("</table></body></html>")
-
-    bio = BytesIO("".join(html).encode("utf-8"))
-    bio.name = "users.html"
-
-    update.message.reply_document(bio, filename=bio.name)
+    """Send ``rows`` as an HTML table. The file is written to a temporary
+    file as the rows are paged in, so the list is never held in memory."""
+    with tempfile.TemporaryFile() as f:
+        f.write((
+            "<html><body>"
+            f"<h2>{title}</h2>"
+            "<table border='1' cellspacing='0' cellpadding='4'>"
+            "<tr><th>ID</th><th>Chat ID</th><th>Username</th><th>Name</th>"
+            "<th>Premium</th><th>Admin</th><th>Last Seen</th></tr>"
+        ).encode("utf-8"))
+        for u in rows:
+            f.write((
+                "<tr>"
+                f"<td>{u['id']}</td>"
+                f"<td>{u['chat_id']}</td>"
+                f"<td>{u['username'] or ''}</td>"
+                f"<td>{u['full_name'] or ''}</td>"
+                f"<td>{'Yes' if u['is_premium'] else 'No'}</td>"
+                f"<td>{'Yes' if u['is_admin'] else 'No'}</td>"
+                f"<td>{u['last_seen']}</td>"
+                "</tr>"
+            ).encode("utf-8"))
+        f.write(b"</table></body></html>")
+        f.seek(0)
+        update.message.reply_document(f, filename="users.html")
 
 
 # ==========================================================
@@ -640,6 +950,20 @@ def _send_users_as_html(update: Update, title: str, rows):
 # ==========================================================
 def main():
     init_db()
+    try:
+        hashed = backfill_document_hashes()
+        if hashed:
+            logger.info("Hashed %d existing documents for deduplication", hashed)
+    except Exception:
+        logger.exception("Failed to hash existing documents")
+    try:
+        queued = prefetch_pending()
+        if queued:
+            logger.info("Pre-extracting %d pending documents", queued)
+    except Exception:
+        logger.exception("Failed to queue pre-extraction of pending documents")
+    # Loads the vector index, or builds it in the background if missing
+    start_index_build()
 
     # Ensure config.ADMIN_IDS are admins in DB
     for cid in ADMIN_IDS:
@@ -668,6 +992,8 @@ def main():
     dp.add_handler(CommandHandler("view_pdf", view_pdf_cmd))
     dp.add_handler(CommandHandler("activate_user", activate_user_cmd))
     dp.add_handler(CommandHandler("add_admin", add_admin_cmd))
+    dp.add_handler(CommandHandler("cache_stats", cache_stats_cmd))
+    dp.add_handler(CommandHandler("llm_stats", llm_stats_cmd))
 
     # QA FEATURE CONVERSATION HANDLERS
     if moa_conv:
@@ -688,9 +1014,26 @@ def main():
     # TEXT (fallback Q&A / SOP)
     dp.add_handler(MessageHandler(Filters.text & ~Filters.command, text_message))
 
+    start_last_seen_flusher()
+    start_message_writer()
+    start_maintenance_scheduler()
+    start_ingest_worker(_ingest_notifier(updater.bot))
+
     updater.start_polling()
     updater.idle()
 
+    stop_ingest_worker()
+    stop_prefetch()
+    stop_maintenance_scheduler()
+    stop_message_writer()
+    stop_last_seen_flusher()
+    try:
+        llm_metrics.flush_rollup()
+    except Exception:
+        logger.exception("Failed to flush LLM usage")
+    close_http_client()
+    close_all_connections()
+
 
 if __name__ == "__main__":
     main()
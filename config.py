@@ -19,9 +19,30 @@ ADMIN_IDS = [
 # FOLDER & DATABASE PATHS
 # =======================
 DB_PATH = "data/pharma_bot.db"
+DB_BUSY_TIMEOUT_MS = 5000        # wait this long on a locked DB before failing
+DB_STATEMENT_CACHE_SIZE = 128    # prepared statements kept per connection
+LAST_SEEN_FLUSH_SECONDS = 30     # how often buffered last_seen updates hit the DB
+MESSAGE_LOG_QUEUE_SIZE = 10000   # transcript rows buffered before new ones are dropped
+MESSAGE_LOG_BATCH_SIZE = 200     # max rows per transcript insert transaction
+MESSAGE_LOG_FLUSH_SECONDS = 0.25 # max time a transcript row waits before being written
+USER_CACHE_TTL_SECONDS = 60      # in-process user row cache (admin checks, quota gate)
+USER_CACHE_MAX_SIZE = 4096
+
+# DB maintenance (see maintenance.py)
+MAINTENANCE_HOUR_UTC = 21        # nightly FTS optimize / ANALYZE / vacuum (≈ 02:30 IST)
+MAINTENANCE_LIGHT_INTERVAL_MINUTES = 60   # FTS merge + WAL checkpoint
 BOOKS_FOLDER = "books"
 PENDING_PDFS_FOLDER = "pending_pdfs"
 
+# PDF text extraction (see pdf_ingest.py)
+PDF_EXTRACT_WORKERS = 0          # processes for page extraction (0 = one per CPU)
+PDF_PARALLEL_MIN_PAGES = 40      # smaller PDFs are read serially (pool start-up cost)
+INGEST_BATCH_CHUNKS = 200        # chunks written (and committed) per ingestion batch
+INGEST_PROGRESS_INTERVAL_SECONDS = 5   # min time between progress edits to the admin
+INGEST_POLL_SECONDS = 30         # idle ingestion worker re-checks the job table this often
+EXTRACT_PREFETCH_ENABLED = True  # extract + chunk uploads in the background before approval
+EXTRACT_CACHE_DIR = "data/extract_cache"   # compressed chunk sidecars, keyed by SHA-256
+
 # Auto-create required folders
 import os
 os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
@@ -60,6 +81,67 @@ LLM_API_KEY = "sk-89395d8aaacb47b99456f771daa5212c"
 LLM_MODEL_NAME = "deepseek-chat"
 LLM_TEMPERATURE = 0.2
 
+# HTTP client for the LLM API (shared keep-alive pool, see ai_engine.py)
+LLM_CONNECT_TIMEOUT = 10         # seconds to establish TCP + TLS
+LLM_READ_TIMEOUT = 120           # seconds to wait for the completion
+LLM_MAX_CONNECTIONS = 20
+LLM_MAX_KEEPALIVE_CONNECTIONS = 10
+LLM_MAX_RETRIES = 3              # retries on 429 / 5xx / connection errors
+LLM_RETRY_BACKOFF = 1.0          # base seconds, doubled each retry
+LLM_RETRY_MAX_DELAY = 30
+
+# Extra OpenAI-compatible endpoints to fail over to (see llm_router.py).
+# LLM_API_BASE above is always tried first while it is healthy.
+LLM_FALLBACK_ENDPOINTS = [
+    # {"name": "openrouter",
+    #  "url": "https://openrouter.ai/api/v1/chat/completions",
+    #  "api_key": "sk-or-...",
+    #  "model": "deepseek/deepseek-chat"},
+]
+LLM_ROUTER_WINDOW = 50               # recent calls kept per endpoint for stats
+LLM_ENDPOINT_MAX_ERROR_RATE = 0.5    # demote an endpoint above this error rate...
+LLM_ENDPOINT_FAILURE_THRESHOLD = 3   # ...or after this many failures in a row
+LLM_ENDPOINT_COOLDOWN_SECONDS = 30   # for this long
+LLM_HEDGE_ENABLED = False            # also ask the next endpoint if the first is slow
+LLM_HEDGE_MIN_DELAY_SECONDS = 2.0    # never hedge earlier than this (or the endpoint's p95)
+
+# Prompt context packing (see context_packer.py)
+CONTEXT_TOKEN_BUDGET = 1800      # max tokens of reference text per question
+CONTEXT_CANDIDATES = 10          # ranked chunks considered before packing
+TOKENIZER_ENCODING = "cl100k_base"
+
+# Offline dense-vector index for hybrid retrieval (see vector_index.py)
+VECTOR_INDEX_ENABLED = True
+VECTOR_INDEX_DIR = "data/vector_index"
+VECTOR_DIM = 256                 # TF-IDF + SVD embedding size
+VECTOR_CANDIDATES = 20           # hits taken from each retriever before fusion
+HYBRID_RRF_K = 60                # reciprocal rank fusion constant
+
+# Answer cache for repeated questions (see answer_cache.py)
+ANSWER_CACHE_ENABLED = True
+ANSWER_CACHE_TTL_SECONDS = 7 * 24 * 3600
+ANSWER_CACHE_MAX_ENTRIES = 5000
+
+# LLM admission control (see llm_scheduler.py)
+LLM_MAX_CONCURRENCY = 4          # LLM requests in flight at once
+LLM_USER_RATE_PER_MINUTE = 6     # sustained questions per user...
+LLM_USER_BURST = 3               # ...with this many allowed back-to-back
+LLM_QUEUE_TIMEOUT_SECONDS = 120
+
+# LLM cost accounting (USD per 1M tokens — check your provider's pricing)
+LLM_PRICE_PROMPT_PER_1M = 0.27
+LLM_PRICE_COMPLETION_PER_1M = 1.10
+LLM_USAGE_FLUSH_MINUTES = 5      # how often the daily usage rollup is written
+
+# SOPs: short outline call, then all sections generated in parallel
+SOP_PARALLEL_SECTIONS = True
+SOP_SECTION_CONCURRENCY = 8      # section requests for one SOP (each still takes an LLM slot)
+
+# Stream answers into Telegram by editing a placeholder message
+LLM_STREAMING = True
+STREAM_EDIT_INTERVAL_SECONDS = 1.0   # at most one edit per interval...
+STREAM_EDIT_MIN_CHARS = 40           # ...and only once this many new chars arrived
+
 
 # =======================
 # BOT INFO
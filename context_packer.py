@@ -0,0 +1,106 @@
+import logging
+import re
+import threading
+from math import ceil
+from typing import List, Tuple
+
+from config import TOKENIZER_ENCODING
+
+logger = logging.getLogger(__name__)
+
+# Below this many free tokens a trimmed chunk is not worth sending
+MIN_PARTIAL_TOKENS = 60
+# A chunk whose lines are mostly already in the context is skipped
+OVERLAP_THRESHOLD = 0.8
+CHUNK_SEPARATOR = "\n\n---\n\n"
+
+_encoding = None
+_encoding_failed = False
+_encoding_lock = threading.Lock()
+
+_WS_RE = re.compile(r"\s+")
+
+
+def _get_encoding():
+    """tiktoken encoding, or None if it cannot be loaded (e.g. offline)."""
+    global _encoding, _encoding_failed
+    if _encoding is not None or _encoding_failed:
+        return _encoding
+    with _encoding_lock:
+        if _encoding is None and not _encoding_failed:
+            try:
+                import tiktoken
+                _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+            except Exception as e:
+                _encoding_failed = True
+                logger.warning("tiktoken unavailable (%s), estimating tokens from length", e)
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    enc = _get_encoding()
+    if enc is None:
+        return ceil(len(text) / 4)
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    if max_tokens <= 0:
+        return ""
+    enc = _get_encoding()
+    if enc is None:
+        return text[: max_tokens * 4]
+    tokens = enc.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return enc.decode(tokens[:max_tokens])
+
+
+def _lines(text: str) -> List[str]:
+    return [_WS_RE.sub(" ", l).strip().lower() for l in text.split("\n") if l.strip()]
+
+
+def pack_context(rows, budget_tokens: int) -> Tuple[str, List[int], int]:
+    """Fill ``budget_tokens`` with chunk text in the given (relevance) order.
+
+    ``rows`` need ``chunk_id`` and ``content``. Exact duplicates and chunks
+    that mostly repeat lines already packed are skipped; the last chunk is
+    trimmed to fit if enough budget is left.
+
+    Returns (context_text, chunk_ids_used, context_tokens).
+    """
+    parts = []
+    used_ids = []
+    seen_lines = set()
+    sep_tokens = count_tokens(CHUNK_SEPARATOR)
+    remaining = budget_tokens
+
+    for row in rows:
+        content = (row["content"] or "").strip()
+        if not content:
+            continue
+
+        lines = _lines(content)
+        if lines:
+            repeated = sum(1 for l in lines if l in seen_lines)
+            if repeated / len(lines) >= OVERLAP_THRESHOLD:
+                continue
+
+        cost = count_tokens(content) + (sep_tokens if parts else 0)
+        if cost > remaining:
+            room = remaining - (sep_tokens if parts else 0)
+            if room < MIN_PARTIAL_TOKENS:
+                break
+            content = truncate_to_tokens(content, room)
+            cost = count_tokens(content) + (sep_tokens if parts else 0)
+
+        parts.append(content)
+        used_ids.append(row["chunk_id"])
+        seen_lines.update(lines)
+        remaining -= cost
+        if remaining <= 0:
+            break
+
+    return CHUNK_SEPARATOR.join(parts), used_ids, budget_tokens - remaining
@@ -1,20 +1,108 @@
+import logging
 import sqlite3
 import os
+import queue
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from config import DB_PATH
+from config import (
+    DB_PATH,
+    DB_BUSY_TIMEOUT_MS,
+    DB_STATEMENT_CACHE_SIZE,
+    LAST_SEEN_FLUSH_SECONDS,
+    MESSAGE_LOG_QUEUE_SIZE,
+    MESSAGE_LOG_BATCH_SIZE,
+    MESSAGE_LOG_FLUSH_SECONDS,
+    USER_CACHE_TTL_SECONDS,
+    USER_CACHE_MAX_SIZE,
+)
 
+logger = logging.getLogger(__name__)
 
-def get_connection():
+
+# --------------------------------------------------------------
+#                   CONNECTION MANAGER
+# --------------------------------------------------------------
+# One long-lived connection per thread (telegram's dispatcher runs
+# handlers on a small worker pool), so each handler reuses an open
+# connection and its prepared-statement cache instead of paying for
+# connect/close on every call. WAL + synchronous=NORMAL means a commit
+# appends to the WAL without an fsync; readers never block the writer.
+
+_local = threading.local()
+_all_connections = []
+_all_connections_lock = threading.Lock()
+
+
+def _open_connection():
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=DB_BUSY_TIMEOUT_MS / 1000.0,
+        cached_statements=DB_STATEMENT_CACHE_SIZE,
+        check_same_thread=False,
+    )
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT_MS)}")
+    return conn
+
+
+def get_connection():
+    """Return this thread's shared connection, opening it on first use.
+
+    Callers must NOT close it. Use ``with conn:`` around writes so the
+    transaction is committed (or rolled back on error) before the
+    connection is reused by the next call on this thread.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _open_connection()
+        _local.conn = conn
+        with _all_connections_lock:
+            _all_connections.append(conn)
     return conn
 
 
+def close_connection():
+    """Close the calling thread's connection (if any)."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        return
+    _local.conn = None
+    with _all_connections_lock:
+        if conn in _all_connections:
+            _all_connections.remove(conn)
+    conn.close()
+
+
+def close_all_connections():
+    """Close every connection opened by this process. Call at shutdown."""
+    with _all_connections_lock:
+        conns = list(_all_connections)
+        _all_connections.clear()
+    for conn in conns:
+        try:
+            conn.close()
+        except Exception:
+            pass
+    _local.conn = None
+
+
 def init_db():
     conn = get_connection()
     cur = conn.cursor()
 
+    # Incremental auto-vacuum lets maintenance return free pages without a
+    # full VACUUM. Switching an existing DB needs one VACUUM to take effect.
+    if cur.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        cur.execute("VACUUM")
+
     # Users table
     cur.execute(
         """CREATE TABLE IF NOT EXISTS users (
@@ -36,6 +124,16 @@ def init_db():
     except:
         pass  # Ignore if already exists
 
+    # Admin user listings filter/sort on these
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users(last_seen)")
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_premium_last_seen ON users(is_premium, last_seen)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_users_premium_seen_order "
+        "ON users(is_premium, COALESCE(last_seen, ''))"
+    )
+
     # Messages table
     cur.execute(
         """CREATE TABLE IF NOT EXISTS messages (
@@ -59,9 +157,15 @@ def init_db():
             approved_by_admin_id INTEGER,
             status TEXT,
             created_at TEXT,
-            approved_at TEXT
+            approved_at TEXT,
+            content_sha256 TEXT,
+            duplicate_of INTEGER
         )"""
     )
+    _migrate_document_hash(cur)
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_documents_sha256 ON documents(content_sha256)"
+    )
 
     # Document chunks
     cur.execute(
@@ -71,14 +175,112 @@ def init_db():
             chunk_index INTEGER,
             content TEXT,
             token_count INTEGER,
+            page_start INTEGER,
+            page_end INTEGER,
             FOREIGN KEY(document_id) REFERENCES documents(id)
         )"""
     )
 
-    # Search table
+    _migrate_chunk_pages(cur)
+
+    # Search table (external-content FTS5 over document_chunks)
+    _migrate_doc_search(cur)
     cur.execute(
         """CREATE VIRTUAL TABLE IF NOT EXISTS doc_search
-            USING fts5(content)"""
+            USING fts5(content, content='document_chunks', content_rowid='id')"""
+    )
+
+    # Keep doc_search in sync with document_chunks
+    cur.execute(
+        """CREATE TRIGGER IF NOT EXISTS document_chunks_ai
+            AFTER INSERT ON document_chunks BEGIN
+                INSERT INTO doc_search(rowid, content) VALUES (new.id, new.content);
+            END"""
+    )
+    cur.execute(
+        """CREATE TRIGGER IF NOT EXISTS document_chunks_ad
+            AFTER DELETE ON document_chunks BEGIN
+                INSERT INTO doc_search(doc_search, rowid, content)
+                    VALUES ('delete', old.id, old.content);
+            END"""
+    )
+    cur.execute(
+        """CREATE TRIGGER IF NOT EXISTS document_chunks_au
+            AFTER UPDATE OF content ON document_chunks BEGIN
+                INSERT INTO doc_search(doc_search, rowid, content)
+                    VALUES ('delete', old.id, old.content);
+                INSERT INTO doc_search(rowid, content) VALUES (new.id, new.content);
+            END"""
+    )
+
+    # Cached LLM answers, keyed on normalized question + retrieved chunk ids
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS answer_cache (
+            cache_key TEXT PRIMARY KEY,
+            question TEXT,
+            chunk_ids TEXT,
+            answer TEXT,
+            hits INTEGER DEFAULT 0,
+            created_at TEXT,
+            last_used_at TEXT
+        )"""
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_answer_cache_last_used ON answer_cache(last_used_at)"
+    )
+    # Newly approved documents can change the right answer: drop the cache
+    cur.execute(
+        """CREATE TRIGGER IF NOT EXISTS documents_approved_au
+            AFTER UPDATE OF status ON documents
+            WHEN new.status = 'approved' AND old.status IS NOT 'approved' BEGIN
+                DELETE FROM answer_cache;
+            END"""
+    )
+    cur.execute(
+        """CREATE TRIGGER IF NOT EXISTS documents_approved_ai
+            AFTER INSERT ON documents
+            WHEN new.status = 'approved' BEGIN
+                DELETE FROM answer_cache;
+            END"""
+    )
+
+    # Daily LLM usage rollup per user and entry point (see llm_metrics.py)
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS llm_usage_daily (
+            day TEXT,
+            user_id INTEGER,
+            entry_point TEXT,
+            calls INTEGER DEFAULT 0,
+            errors INTEGER DEFAULT 0,
+            prompt_tokens INTEGER DEFAULT 0,
+            completion_tokens INTEGER DEFAULT 0,
+            latency_ms_total REAL DEFAULT 0,
+            PRIMARY KEY (day, user_id, entry_point)
+        )"""
+    )
+
+    # Background PDF ingestion jobs (see ingest_jobs.py)
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS ingest_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            document_id INTEGER,
+            admin_user_id INTEGER,
+            chat_id INTEGER,
+            status_message_id INTEGER,
+            status TEXT,
+            pages_total INTEGER DEFAULT 0,
+            pages_done INTEGER DEFAULT 0,
+            chunks_done INTEGER DEFAULT 0,
+            attempts INTEGER DEFAULT 0,
+            error TEXT,
+            created_at TEXT,
+            started_at TEXT,
+            finished_at TEXT,
+            FOREIGN KEY(document_id) REFERENCES documents(id)
+        )"""
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_ingest_jobs_status ON ingest_jobs(status, id)"
     )
 
     # Regulatory alerts table
@@ -92,195 +294,1009 @@ def init_db():
     )
 
     conn.commit()
-    conn.close()
+
+
+def _migrate_document_hash(cur):
+    """Add the content_sha256 / duplicate_of columns to older databases.
+    Existing documents are hashed by pdf_approval.backfill_document_hashes."""
+    cur.execute("PRAGMA table_info(documents)")
+    columns = {row[1] for row in cur.fetchall()}
+    for column, kind in (("content_sha256", "TEXT"), ("duplicate_of", "INTEGER")):
+        if column not in columns:
+            cur.execute(f"ALTER TABLE documents ADD COLUMN {column} {kind}")
+
+
+def _migrate_chunk_pages(cur):
+    """Add the page_start / page_end columns to older databases.
+    Chunks ingested before them keep NULL pages."""
+    cur.execute("PRAGMA table_info(document_chunks)")
+    columns = {row[1] for row in cur.fetchall()}
+    for column in ("page_start", "page_end"):
+        if column not in columns:
+            cur.execute(f"ALTER TABLE document_chunks ADD COLUMN {column} INTEGER")
+
+
+def _migrate_doc_search(cur):
+    """One-shot migration from the old self-contained doc_search table.
+
+    Earlier versions stored every chunk twice (document_chunks.content and
+    a plain fts5 table). Drop the old index, recreate it as an
+    external-content table and rebuild it from the existing rows.
+    """
+    cur.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'doc_search'")
+    row = cur.fetchone()
+    if not row or "content=" in (row[0] or "").replace(" ", ""):
+        return
+
+    cur.execute("DROP TABLE doc_search")
+    cur.execute(
+        """CREATE VIRTUAL TABLE doc_search
+            USING fts5(content, content='document_chunks', content_rowid='id')"""
+    )
+    cur.execute("INSERT INTO doc_search(doc_search) VALUES ('rebuild')")
+    cur.connection.commit()
+    # Give the freed pages of the old copy back to the filesystem
+    cur.execute("VACUUM")
+
+
+# --------------------------------------------------------------
+#                   MAINTENANCE PRIMITIVES
+# --------------------------------------------------------------
+
+def db_size_bytes() -> int:
+    """Size of the database file plus its WAL."""
+    total = 0
+    for path in (DB_PATH, DB_PATH + "-wal"):
+        try:
+            total += os.path.getsize(path)
+        except OSError:
+            pass
+    return total
+
+
+def fts_merge(pages: int = 500):
+    """Incrementally merge FTS5 segments (cheap, safe to run often)."""
+    conn = get_connection()
+    with conn:
+        conn.execute("INSERT INTO doc_search(doc_search, rank) VALUES ('merge', ?)", (pages,))
+
+
+def fts_optimize():
+    """Merge all FTS5 segments into one b-tree."""
+    conn = get_connection()
+    with conn:
+        conn.execute("INSERT INTO doc_search(doc_search) VALUES ('optimize')")
+
+
+def pragma_optimize():
+    """Refresh query planner statistics where SQLite thinks it helps."""
+    conn = get_connection()
+    conn.execute("PRAGMA analysis_limit=1000")
+    conn.execute("PRAGMA optimize")
+
+
+def wal_checkpoint(mode: str = "PASSIVE"):
+    """Run a WAL checkpoint. Returns (busy, wal_pages, checkpointed_pages)."""
+    if mode not in ("PASSIVE", "FULL", "RESTART", "TRUNCATE"):
+        raise ValueError(f"Unknown checkpoint mode: {mode}")
+    conn = get_connection()
+    return tuple(conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone())
+
+
+def incremental_vacuum(pages: int = 0):
+    """Return up to ``pages`` free pages to the filesystem (0 = all)."""
+    conn = get_connection()
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
 
 
 def _now():
     return datetime.utcnow().isoformat(timespec="seconds")
 
 
+# --------------------------------------------------------------
+#                   USER ROW CACHE
+# --------------------------------------------------------------
+# A single update can look the same user up several times (admin checks,
+# keyboard building, quota gate). Rows are cached per chat_id for
+# USER_CACHE_TTL_SECONDS with LRU eviction; every function that changes
+# a user's admin/premium/quota fields invalidates its entry.
+
+_user_cache = OrderedDict()   # chat_id -> (expires_at, row)
+_user_cache_ids = {}          # users.id -> chat_id, for invalidation by id
+_user_cache_lock = threading.Lock()
+
+
+def _user_cache_get(chat_id: int):
+    with _user_cache_lock:
+        entry = _user_cache.get(chat_id)
+        if entry is None:
+            return None
+        expires_at, row = entry
+        if expires_at < time.monotonic():
+            del _user_cache[chat_id]
+            _user_cache_ids.pop(row["id"], None)
+            return None
+        _user_cache.move_to_end(chat_id)
+        return row
+
+
+def _user_cache_put(row):
+    if row is None:
+        return
+    with _user_cache_lock:
+        _user_cache[row["chat_id"]] = (time.monotonic() + USER_CACHE_TTL_SECONDS, row)
+        _user_cache.move_to_end(row["chat_id"])
+        _user_cache_ids[row["id"]] = row["chat_id"]
+        while len(_user_cache) > USER_CACHE_MAX_SIZE:
+            _, (_, old) = _user_cache.popitem(last=False)
+            _user_cache_ids.pop(old["id"], None)
+
+
+def invalidate_user(chat_id: int = None, user_id: int = None):
+    """Drop a cached user row, by chat_id or users.id."""
+    with _user_cache_lock:
+        if chat_id is None:
+            chat_id = _user_cache_ids.get(user_id)
+        entry = _user_cache.pop(chat_id, None)
+        if entry:
+            _user_cache_ids.pop(entry[1]["id"], None)
+
+
+def clear_user_cache():
+    with _user_cache_lock:
+        _user_cache.clear()
+        _user_cache_ids.clear()
+
+
 def get_or_create_user(chat_id: int, username: str = None, full_name: str = None):
+    row = get_user_by_chat_id(chat_id)
+    if row:
+        touch_last_seen(chat_id)
+        return row
+
     conn = get_connection()
     cur = conn.cursor()
-
-    cur.execute("SELECT * FROM users WHERE chat_id = ?", (chat_id,))
-    row = cur.fetchone()
-    if row:
+    with conn:
         cur.execute(
-            "UPDATE users SET last_seen = ? WHERE chat_id = ?",
-            (_now(), chat_id),
+            """INSERT OR IGNORE INTO users (chat_id, username, full_name, free_messages,
+                                  is_premium, is_admin, created_at, last_seen)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (chat_id, username, full_name, 150, 0, 0, _now(), _now()),
         )
-        conn.commit()
-        conn.close()
-        return row
-
-    cur.execute(
-        """INSERT INTO users (chat_id, username, full_name, free_messages,
-                              is_premium, is_admin, created_at, last_seen)
-           VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-        (chat_id, username, full_name, 150, 0, 0, _now(), _now()),
-    )
-    conn.commit()
     cur.execute("SELECT * FROM users WHERE chat_id = ?", (chat_id,))
     row = cur.fetchone()
-    conn.close()
+    _user_cache_put(row)
     return row
 
 
+# --------------------------------------------------------------
+#                   LAST_SEEN WRITE-BEHIND
+# --------------------------------------------------------------
+# last_seen only feeds the admin "online users" view, so instead of an
+# UPDATE + commit per incoming message we remember the latest timestamp
+# per chat_id and write them all in one batch every
+# LAST_SEEN_FLUSH_SECONDS (and at shutdown).
+
+_pending_last_seen = {}
+_pending_last_seen_lock = threading.Lock()
+_last_seen_stop = threading.Event()
+_last_seen_thread = None
+
+
+def touch_last_seen(chat_id: int):
+    with _pending_last_seen_lock:
+        _pending_last_seen[chat_id] = _now()
+
+
+def flush_last_seen() -> int:
+    """Write all buffered last_seen values. Returns how many were written."""
+    with _pending_last_seen_lock:
+        if not _pending_last_seen:
+            return 0
+        pending = list(_pending_last_seen.items())
+        _pending_last_seen.clear()
+
+    conn = get_connection()
+    try:
+        with conn:
+            conn.executemany(
+                "UPDATE users SET last_seen = ? WHERE chat_id = ? AND "
+                "(last_seen IS NULL OR last_seen < ?)",
+                [(ts, chat_id, ts) for chat_id, ts in pending],
+            )
+    except Exception:
+        # Put them back (without clobbering newer touches) and retry next time
+        with _pending_last_seen_lock:
+            for chat_id, ts in pending:
+                _pending_last_seen.setdefault(chat_id, ts)
+        raise
+    return len(pending)
+
+
+def _last_seen_loop(interval: float):
+    while not _last_seen_stop.wait(interval):
+        try:
+            flush_last_seen()
+        except Exception:
+            logger.exception("Failed to flush last_seen updates")
+
+
+def start_last_seen_flusher(interval: float = LAST_SEEN_FLUSH_SECONDS):
+    global _last_seen_thread
+    if _last_seen_thread and _last_seen_thread.is_alive():
+        return
+    _last_seen_stop.clear()
+    _last_seen_thread = threading.Thread(
+        target=_last_seen_loop, args=(interval,), name="last-seen-flusher", daemon=True
+    )
+    _last_seen_thread.start()
+
+
+def stop_last_seen_flusher():
+    """Stop the background flusher and write whatever is still buffered."""
+    global _last_seen_thread
+    _last_seen_stop.set()
+    if _last_seen_thread:
+        _last_seen_thread.join(timeout=5)
+        _last_seen_thread = None
+    flush_last_seen()
+
+
 def get_user_by_chat_id(chat_id: int):
+    row = _user_cache_get(chat_id)
+    if row is not None:
+        return row
     conn = get_connection()
     cur = conn.cursor()
     cur.execute("SELECT * FROM users WHERE chat_id = ?", (chat_id,))
     row = cur.fetchone()
-    conn.close()
+    _user_cache_put(row)
     return row
 
 
 def update_user_messages(user_id: int, delta: int):
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "UPDATE users SET free_messages = free_messages + ? WHERE id = ?",
-        (delta, user_id),
-    )
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.execute(
+            "UPDATE users SET free_messages = free_messages + ? WHERE id = ?",
+            (delta, user_id),
+        )
+    invalidate_user(user_id=user_id)
+
+
+def reserve_user_message(user_id: int):
+    """Atomically take one free message from a user's quota.
+
+    Premium users are never decremented. Returns the updated row
+    (``is_premium``, ``free_messages``) if the user may ask, or None if the
+    quota is exhausted (or the user does not exist).
+    """
+    conn = get_connection()
+    with conn:
+        cur = conn.execute(
+            """UPDATE users
+                SET free_messages = CASE WHEN is_premium THEN free_messages
+                                         ELSE free_messages - 1 END
+                WHERE id = ? AND (is_premium OR free_messages > 0)
+                RETURNING is_premium, free_messages""",
+            (user_id,),
+        )
+        row = cur.fetchone()
+    invalidate_user(user_id=user_id)
+    return row
 
 
 def set_user_premium(chat_id: int, premium: bool = True):
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "UPDATE users SET is_premium = ?, free_messages = ? WHERE chat_id = ?",
-        (1 if premium else 0, 999999 if premium else 150, chat_id),
-    )
-    conn.commit()
-    conn.close()
+    with conn:
+        conn.execute(
+            "UPDATE users SET is_premium = ?, free_messages = ? WHERE chat_id = ?",
+            (1 if premium else 0, 999999 if premium else 150, chat_id),
+        )
+    invalidate_user(chat_id=chat_id)
 
 
-def save_message(user_id: int, role: str, content: str):
+# --------------------------------------------------------------
+#                   MESSAGE LOG WRITER
+# --------------------------------------------------------------
+# Transcript rows are handed to a background thread through a bounded
+# queue and inserted in batches (every MESSAGE_LOG_FLUSH_SECONDS or
+# MESSAGE_LOG_BATCH_SIZE rows), so save_message never waits on SQLite.
+# If the writer is not running, save_message writes synchronously.
+
+_message_queue = queue.Queue(maxsize=MESSAGE_LOG_QUEUE_SIZE)
+_message_writer = None
+_message_writer_stop = object()
+_message_stats = {"queued": 0, "written": 0, "dropped": 0, "failed": 0}
+_message_stats_lock = threading.Lock()
+
+
+def _bump(key: str, n: int = 1):
+    with _message_stats_lock:
+        _message_stats[key] += n
+
+
+def _insert_messages(rows):
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO messages (user_id, role, content, created_at) VALUES (?, ?, ?, ?)",
-        (user_id, role, content, _now()),
+    with conn:
+        conn.executemany(
+            "INSERT INTO messages (user_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+            rows,
+        )
+
+
+def save_message(user_id: int, role: str, content: str):
+    row = (user_id, role, content, _now())
+    if _message_writer is None:
+        _insert_messages([row])
+        _bump("written")
+        return
+    try:
+        _message_queue.put_nowait(row)
+        _bump("queued")
+    except queue.Full:
+        _bump("dropped")
+        logger.warning("Message log queue full, dropped a %s message", role)
+
+
+def _message_writer_loop():
+    stopping = False
+    while not stopping:
+        item = _message_queue.get()
+        if item is _message_writer_stop:
+            break
+        batch = [item]
+        deadline = time.monotonic() + MESSAGE_LOG_FLUSH_SECONDS
+        while len(batch) < MESSAGE_LOG_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = _message_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _message_writer_stop:
+                stopping = True
+                break
+            batch.append(item)
+        try:
+            _insert_messages(batch)
+            _bump("written", len(batch))
+        except Exception:
+            _bump("failed", len(batch))
+            logger.exception("Failed to write %d transcript messages", len(batch))
+
+    # Drain anything that raced in behind the stop marker
+    leftover = []
+    while True:
+        try:
+            item = _message_queue.get_nowait()
+        except queue.Empty:
+            break
+        if item is not _message_writer_stop:
+            leftover.append(item)
+    if leftover:
+        try:
+            _insert_messages(leftover)
+            _bump("written", len(leftover))
+        except Exception:
+            _bump("failed", len(leftover))
+            logger.exception("Failed to write %d transcript messages", len(leftover))
+
+
+def start_message_writer():
+    global _message_writer
+    if _message_writer and _message_writer.is_alive():
+        return
+    _message_writer = threading.Thread(
+        target=_message_writer_loop, name="message-log-writer", daemon=True
     )
-    conn.commit()
-    conn.close()
+    _message_writer.start()
 
 
-def insert_document(title, filename, pages, uploaded_by_user_id, status="pending"):
+def stop_message_writer(timeout: float = 10):
+    """Flush every queued message and stop the writer thread."""
+    global _message_writer
+    writer = _message_writer
+    if writer is None:
+        return
+    _message_queue.put(_message_writer_stop)
+    writer.join(timeout=timeout)
+    _message_writer = None
+
+
+def message_log_stats() -> dict:
+    """Counters for the transcript writer, plus the current queue depth."""
+    with _message_stats_lock:
+        stats = dict(_message_stats)
+    stats["pending"] = _message_queue.qsize()
+    return stats
+
+
+def insert_document(title, filename, pages, uploaded_by_user_id, status="pending",
+                    content_sha256=None, duplicate_of=None):
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """INSERT INTO documents
-            (title, filename, pages, uploaded_by_user_id, status, created_at)
-            VALUES (?, ?, ?, ?, ?, ?)""",
-        (title, filename, pages, uploaded_by_user_id, status, _now()),
-    )
-    conn.commit()
-    doc_id = cur.lastrowid
-    conn.close()
-    return doc_id
+    with conn:
+        cur = conn.execute(
+            """INSERT INTO documents
+                (title, filename, pages, uploaded_by_user_id, status, created_at,
+                 content_sha256, duplicate_of)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (title, filename, pages, uploaded_by_user_id, status, _now(),
+             content_sha256, duplicate_of),
+        )
+    return cur.lastrowid
 
 
-def update_document_status(doc_id: int, status: str, approved_by_admin_id=None):
+def find_document_by_hash(content_sha256: str, exclude_id: int = None):
+    """The canonical document with this content: approved first, then the
+    oldest pending upload. Duplicates and rejected documents never match."""
     conn = get_connection()
-    cur = conn.cursor()
-    if status == "approved":
-        cur.execute(
-            """UPDATE documents
-                SET status = ?, approved_by_admin_id = ?, approved_at = ?
-                WHERE id = ?""",
-            (status, approved_by_admin_id, _now(), doc_id),
+    return conn.execute(
+        """SELECT * FROM documents
+            WHERE content_sha256 = ?
+              AND status IN ('approved', 'pending')
+              AND id != ?
+            ORDER BY status = 'approved' DESC, id
+            LIMIT 1""",
+        (content_sha256, exclude_id if exclude_id is not None else -1),
+    ).fetchone()
+
+
+def set_document_hash(doc_id: int, content_sha256: str):
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            "UPDATE documents SET content_sha256 = ? WHERE id = ?",
+            (content_sha256, doc_id),
         )
-    else:
-        cur.execute(
-            "UPDATE documents SET status = ? WHERE id = ?",
-            (status, doc_id),
+
+
+def list_unhashed_documents():
+    conn = get_connection()
+    return conn.execute(
+        """SELECT * FROM documents
+            WHERE content_sha256 IS NULL AND status IN ('approved', 'pending')
+            ORDER BY id"""
+    ).fetchall()
+
+
+def mark_document_duplicate(doc_id: int, original_id: int):
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            "UPDATE documents SET status = 'duplicate', duplicate_of = ? WHERE id = ?",
+            (original_id, doc_id),
         )
-    conn.commit()
-    conn.close()
+
+
+def update_document_status(doc_id: int, status: str, approved_by_admin_id=None):
+    conn = get_connection()
+    with conn:
+        if status == "approved":
+            conn.execute(
+                """UPDATE documents
+                    SET status = ?, approved_by_admin_id = ?, approved_at = ?
+                    WHERE id = ?""",
+                (status, approved_by_admin_id, _now(), doc_id),
+            )
+        else:
+            conn.execute(
+                "UPDATE documents SET status = ? WHERE id = ?",
+                (status, doc_id),
+            )
 
 
 def add_document_chunk(document_id: int, chunk_index: int, content: str, token_count: int):
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """INSERT INTO document_chunks
-            (document_id, chunk_index, content, token_count)
-            VALUES (?, ?, ?, ?)""",
-        (document_id, chunk_index, content, token_count),
+    with conn:
+        conn.execute(
+            """INSERT INTO document_chunks
+                (document_id, chunk_index, content, token_count)
+                VALUES (?, ?, ?, ?)""",
+            (document_id, chunk_index, content, token_count),
+        )
+
+
+def set_document_pages(doc_id: int, pages: int):
+    conn = get_connection()
+    with conn:
+        conn.execute("UPDATE documents SET pages = ? WHERE id = ?", (pages, doc_id))
+
+
+def add_document_chunks(document_id: int, chunks, batch_size: int = 0,
+                        on_commit=None) -> int:
+    """Bulk-insert chunks for one document with executemany.
+
+    ``chunks`` is an iterable of ``(chunk_index, content, token_count)``
+    or ``(chunk_index, content, token_count, page_start, page_end)``;
+    the doc_search triggers index each row as it is inserted.
+    By default everything is written in one transaction; with
+    ``batch_size`` > 0 a commit is issued every ``batch_size`` chunks so
+    the iterable can be consumed lazily, and ``on_commit(written)`` is
+    called after each commit. If anything fails, every chunk written by
+    this call is removed again and the error is re-raised.
+    Returns the number of chunks written.
+    """
+    conn = get_connection()
+    first_id = None
+    written = 0
+    batch = []
+
+    def _flush():
+        nonlocal first_id
+        cur = conn.executemany(
+            """INSERT INTO document_chunks
+                (document_id, chunk_index, content, token_count, page_start, page_end)
+                VALUES (?, ?, ?, ?, ?, ?)""",
+            [(document_id, *chunk) for chunk in batch],
+        )
+        if first_id is None:
+            last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+            first_id = last_id - cur.rowcount + 1
+        batch.clear()
+
+    try:
+        for chunk in chunks:
+            if len(chunk) == 3:
+                chunk = (*chunk, None, None)   # no page numbers
+            batch.append(chunk)
+            written += 1
+            if batch_size and len(batch) >= batch_size:
+                _flush()
+                conn.commit()
+                if on_commit is not None:
+                    on_commit(written)
+        if batch:
+            _flush()
+        conn.commit()
+        if on_commit is not None:
+            on_commit(written)
+    except Exception:
+        conn.rollback()
+        if first_id is not None:
+            with conn:
+                conn.execute(
+                    "DELETE FROM document_chunks WHERE document_id = ? AND id >= ?",
+                    (document_id, first_id),
+                )
+        raise
+    return written
+
+
+_FTS_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def replace_document_chunks(document_id: int, chunks, batch_size: int = 0):
+    """Swap all chunks of a document for ``chunks`` (rows as for
+    add_document_chunks) in a single transaction, so a failure part-way
+    leaves the old chunks in place.
+
+    Rows are inserted ``batch_size`` at a time (0 = all at once) so
+    ``chunks`` is consumed lazily. ``chunks`` must not write to the DB:
+    on this thread's connection that would commit the swap half-done.
+    Returns ``(old_chunk_ids, written)``.
+    """
+    conn = get_connection()
+    written = 0
+    batch = []
+
+    def _flush():
+        conn.executemany(
+            """INSERT INTO document_chunks
+                (document_id, chunk_index, content, token_count, page_start, page_end)
+                VALUES (?, ?, ?, ?, ?, ?)""",
+            [(document_id, *chunk) for chunk in batch],
+        )
+        batch.clear()
+
+    with conn:
+        old_ids = [row[0] for row in conn.execute(
+            "DELETE FROM document_chunks WHERE document_id = ? RETURNING id", (document_id,)
+        ).fetchall()]
+        for chunk in chunks:
+            if len(chunk) == 3:
+                chunk = (*chunk, None, None)   # no page numbers
+            batch.append(chunk)
+            written += 1
+            if batch_size and len(batch) >= batch_size:
+                _flush()
+        if batch:
+            _flush()
+    return old_ids, written
+
+
+def trim_partial_chunks(document_id: int):
+    """Prepare an interrupted ingestion for resuming.
+
+    Chunks are committed in batches, so the last committed chunk may
+    stop part-way through a page. Drop every chunk that touches the page
+    the last chunk started on (and, transitively, chunks reaching back
+    from there) so extraction can restart cleanly at a page boundary.
+    Returns ``(first_page, next_chunk_index, chunks_kept)``; ``(1, 0, 0)``
+    if nothing usable was written.
+    """
+    conn = get_connection()
+    row = conn.execute(
+        """SELECT page_start FROM document_chunks
+            WHERE document_id = ? ORDER BY chunk_index DESC LIMIT 1""",
+        (document_id,),
+    ).fetchone()
+    if row is None or row["page_start"] is None:
+        with conn:
+            conn.execute("DELETE FROM document_chunks WHERE document_id = ?", (document_id,))
+        return 1, 0, 0
+
+    page = row["page_start"]
+    while True:
+        earliest = conn.execute(
+            """SELECT MIN(page_start) FROM document_chunks
+                WHERE document_id = ? AND page_end >= ?""",
+            (document_id, page),
+        ).fetchone()[0]
+        if earliest is None or earliest >= page:
+            break
+        page = earliest
+
+    with conn:
+        conn.execute(
+            "DELETE FROM document_chunks WHERE document_id = ? AND page_end >= ?",
+            (document_id, page),
+        )
+    kept, next_index = conn.execute(
+        """SELECT COUNT(*), COALESCE(MAX(chunk_index) + 1, 0)
+             FROM document_chunks WHERE document_id = ?""",
+        (document_id,),
+    ).fetchone()
+    return page, next_index, kept
+
+
+def build_match_query(text: str) -> str:
+    """Turn free text into a safe FTS5 MATCH expression.
+
+    Raw questions contain FTS5 syntax characters ("?", ".", quotes) and an
+    implicit AND across every word, which rarely matches anything. Each word
+    is quoted and OR-ed instead, leaving relevance to bm25().
+    """
+    terms = []
+    for tok in _FTS_TOKEN_RE.findall(text or ""):
+        tok = tok.lower()
+        if tok not in terms:
+            terms.append(tok)
+    return " OR ".join(f'"{t}"' for t in terms)
+
+
+def search_chunks(query: str, limit: int = 5, weights=None):
+    """Ranked full-text search in a single round trip.
+
+    Returns rows with ``chunk_id`` (also exposed as ``rowid``),
+    ``document_id``, ``chunk_index``, ``content``, ``title`` and ``score``,
+    best match first. ``weights`` are optional per-column bm25() weights
+    for the ``doc_search`` columns, in column order.
+    """
+    match = build_match_query(query)
+    if not match:
+        return []
+
+    weight_args = "".join(f", {float(w)}" for w in (weights or ()))
+    conn = get_connection()
+    cur = conn.execute(
+        f"""SELECT c.id AS chunk_id,
+                   c.id AS rowid,
+                   c.document_id,
+                   c.chunk_index,
+                   c.content,
+                   c.page_start,
+                   c.page_end,
+                   d.title,
+                   bm25(doc_search{weight_args}) AS score
+              FROM doc_search
+              JOIN document_chunks c ON c.id = doc_search.rowid
+              LEFT JOIN documents d ON d.id = c.document_id
+             WHERE doc_search MATCH ?
+             ORDER BY score
+             LIMIT ?""",
+        (match, limit),
     )
-    chunk_id = cur.lastrowid
-    cur.execute("INSERT INTO doc_search(rowid, content) VALUES (?, ?)", (chunk_id, content))
-    conn.commit()
-    conn.close()
+    return cur.fetchall()
 
 
-def search_chunks(query: str, limit: int = 5):
+def get_chunks_by_ids(chunk_ids):
+    """Fetch chunks (same columns as search_chunks, ``score`` NULL) by id,
+    in the order of ``chunk_ids``. Unknown ids are skipped."""
+    chunk_ids = [int(i) for i in chunk_ids]
+    if not chunk_ids:
+        return []
+    placeholders = ",".join("?" * len(chunk_ids))
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT rowid, content FROM doc_search WHERE doc_search MATCH ? LIMIT ?",
-        (query, limit),
+    cur = conn.execute(
+        f"""SELECT c.id AS chunk_id,
+                   c.id AS rowid,
+                   c.document_id,
+                   c.chunk_index,
+                   c.content,
+                   c.page_start,
+                   c.page_end,
+                   d.title,
+                   NULL AS score
+              FROM document_chunks c
+              LEFT JOIN documents d ON d.id = c.document_id
+             WHERE c.id IN ({placeholders})""",
+        chunk_ids,
     )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+    by_id = {row["chunk_id"]: row for row in cur.fetchall()}
+    return [by_id[i] for i in chunk_ids if i in by_id]
+
+
+def iter_chunk_texts(document_id: int = None, batch_size: int = 1000):
+    """Yield (chunk_id, content) for all chunks (or one document) by id."""
+    conn = get_connection()
+    doc_filter = " AND document_id = ?" if document_id is not None else ""
+    last_id = 0
+    while True:
+        params = (last_id, document_id, batch_size) if document_id is not None \
+            else (last_id, batch_size)
+        rows = conn.execute(
+            "SELECT id, content FROM document_chunks WHERE id > ?" + doc_filter +
+            " ORDER BY id LIMIT ?",
+            params,
+        ).fetchall()
+        for row in rows:
+            yield row["id"], row["content"] or ""
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1]["id"]
+
+
+def sample_chunk_texts(limit: int, seed: int = 13):
+    """Contents of up to ``limit`` chunks picked uniformly at random.
+
+    Reservoir-samples the chunk ids, so only ``limit`` ids (and then their
+    texts) are ever held in memory.
+    """
+    rng = random.Random(seed)
+    conn = get_connection()
+    sample = []
+    for seen, (chunk_id,) in enumerate(conn.execute("SELECT id FROM document_chunks")):
+        if seen < limit:
+            sample.append(chunk_id)
+        else:
+            pick = rng.randrange(seen + 1)
+            if pick < limit:
+                sample[pick] = chunk_id
+    sample.sort()
+    texts = []
+    for start in range(0, len(sample), 500):
+        batch = sample[start:start + 500]
+        placeholders = ",".join("?" * len(batch))
+        texts.extend(
+            row[0] or "" for row in conn.execute(
+                f"SELECT content FROM document_chunks WHERE id IN ({placeholders})", batch)
+        )
+    return texts
 
 
 def get_chunk_by_id(chunk_id: int):
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
+    cur = conn.execute(
         "SELECT * FROM document_chunks WHERE id = ?",
         (chunk_id,),
     )
-    row = cur.fetchone()
-    conn.close()
-    return row
+    return cur.fetchone()
 
 
 def list_pending_documents():
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM documents WHERE status = 'pending' ORDER BY created_at DESC")
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+    cur = conn.execute("SELECT * FROM documents WHERE status = 'pending' ORDER BY created_at DESC")
+    return cur.fetchall()
 
 
 def get_document(doc_id: int):
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM documents WHERE id = ?", (doc_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+    cur = conn.execute("SELECT * FROM documents WHERE id = ?", (doc_id,))
+    return cur.fetchone()
 
 
-def insert_alert(title: str, body: str):
+# --------------------------------------------------------------
+#                   INGESTION JOBS
+# --------------------------------------------------------------
+
+def create_ingest_job(document_id: int, admin_user_id: int,
+                      chat_id: int = None, status_message_id: int = None) -> int:
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO regulatory_alerts (title, body, created_at) VALUES (?, ?, ?)",
-        (title, body, _now()),
+    with conn:
+        cur = conn.execute(
+            """INSERT INTO ingest_jobs
+                (document_id, admin_user_id, chat_id, status_message_id, status, created_at)
+                VALUES (?, ?, ?, ?, 'queued', ?)""",
+            (document_id, admin_user_id, chat_id, status_message_id, _now()),
+        )
+    return cur.lastrowid
+
+
+def get_active_ingest_job(document_id: int):
+    """The queued or running job for a document, if any."""
+    conn = get_connection()
+    return conn.execute(
+        """SELECT * FROM ingest_jobs
+            WHERE document_id = ? AND status IN ('queued', 'running')
+            ORDER BY id LIMIT 1""",
+        (document_id,),
+    ).fetchone()
+
+
+def claim_next_ingest_job():
+    """Atomically mark the oldest queued job as running and return it."""
+    conn = get_connection()
+    with conn:
+        return conn.execute(
+            """UPDATE ingest_jobs
+                  SET status = 'running', started_at = ?, attempts = attempts + 1
+                WHERE id = (SELECT id FROM ingest_jobs
+                             WHERE status = 'queued' ORDER BY id LIMIT 1)
+            RETURNING *""",
+            (_now(),),
+        ).fetchone()
+
+
+def update_ingest_progress(job_id: int, pages_total: int, pages_done: int,
+                           chunks_done: int) -> bool:
+    """Save a job's progress. Only call it between transactions: commits
+    here would also commit whatever the caller has open on this thread's
+    connection, so the write is skipped (returns False) in that case."""
+    conn = get_connection()
+    if conn.in_transaction:
+        logger.warning("Not saving progress of ingest job %s inside an open transaction", job_id)
+        return False
+    with conn:
+        conn.execute(
+            """UPDATE ingest_jobs
+                  SET pages_total = ?, pages_done = ?, chunks_done = ?
+                WHERE id = ?""",
+            (pages_total, pages_done, chunks_done, job_id),
+        )
+    return True
+
+
+def finish_ingest_job(job_id: int, status: str, error: str = None):
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            "UPDATE ingest_jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+            (status, error, _now(), job_id),
+        )
+
+
+def requeue_interrupted_ingest_jobs() -> int:
+    """Put jobs left 'running' by a previous process back in the queue."""
+    conn = get_connection()
+    with conn:
+        cur = conn.execute("UPDATE ingest_jobs SET status = 'queued' WHERE status = 'running'")
+    return cur.rowcount
+
+
+# --------------------------------------------------------------
+#                   ANSWER CACHE
+# --------------------------------------------------------------
+
+def get_cached_answer(cache_key: str, ttl_seconds: int):
+    """Return a cached answer newer than ``ttl_seconds`` and mark it used."""
+    cutoff = (datetime.utcnow() - timedelta(seconds=ttl_seconds)).isoformat(timespec="seconds")
+    conn = get_connection()
+    with conn:
+        cur = conn.execute(
+            """UPDATE answer_cache
+                SET hits = hits + 1, last_used_at = ?
+                WHERE cache_key = ? AND created_at >= ?
+                RETURNING answer""",
+            (_now(), cache_key, cutoff),
+        )
+        row = cur.fetchone()
+    return row["answer"] if row else None
+
+
+def put_cached_answer(cache_key: str, question: str, chunk_ids, answer: str, max_entries: int):
+    """Store an answer and evict least-recently-used entries beyond ``max_entries``."""
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            """INSERT OR REPLACE INTO answer_cache
+                (cache_key, question, chunk_ids, answer, hits, created_at, last_used_at)
+                VALUES (?, ?, ?, ?, 0, ?, ?)""",
+            (cache_key, question, ",".join(str(i) for i in chunk_ids), answer, _now(), _now()),
+        )
+        conn.execute(
+            """DELETE FROM answer_cache WHERE cache_key IN (
+                SELECT cache_key FROM answer_cache
+                ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)""",
+            (max_entries,),
+        )
+
+
+def purge_expired_answers(ttl_seconds: int) -> int:
+    cutoff = (datetime.utcnow() - timedelta(seconds=ttl_seconds)).isoformat(timespec="seconds")
+    conn = get_connection()
+    with conn:
+        cur = conn.execute("DELETE FROM answer_cache WHERE created_at < ?", (cutoff,))
+    return cur.rowcount
+
+
+def clear_answer_cache():
+    conn = get_connection()
+    with conn:
+        conn.execute("DELETE FROM answer_cache")
+
+
+def answer_cache_summary() -> dict:
+    conn = get_connection()
+    row = conn.execute(
+        "SELECT COUNT(*) AS entries, COALESCE(SUM(hits), 0) AS hits FROM answer_cache"
+    ).fetchone()
+    return {"entries": row["entries"], "stored_hits": row["hits"]}
+
+
+# --------------------------------------------------------------
+#                   LLM USAGE ROLLUP
+# --------------------------------------------------------------
+
+def add_llm_usage(rows):
+    """Accumulate rollup rows:
+    (day, user_id, entry_point, calls, errors, prompt_tokens, completion_tokens, latency_ms)."""
+    conn = get_connection()
+    with conn:
+        conn.executemany(
+            """INSERT INTO llm_usage_daily
+                (day, user_id, entry_point, calls, errors, prompt_tokens,
+                 completion_tokens, latency_ms_total)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (day, user_id, entry_point) DO UPDATE SET
+                    calls = calls + excluded.calls,
+                    errors = errors + excluded.errors,
+                    prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+                    completion_tokens = completion_tokens + excluded.completion_tokens,
+                    latency_ms_total = latency_ms_total + excluded.latency_ms_total""",
+            rows,
+        )
+
+
+def top_llm_consumers(day_from: str, day_to: str, limit: int = 10):
+    """Users with the most tokens between two days (inclusive, YYYY-MM-DD)."""
+    conn = get_connection()
+    cur = conn.execute(
+        """SELECT r.user_id,
+                  u.chat_id,
+                  u.username,
+                  u.full_name,
+                  SUM(r.calls) AS calls,
+                  SUM(r.prompt_tokens) AS prompt_tokens,
+                  SUM(r.completion_tokens) AS completion_tokens
+             FROM llm_usage_daily r
+             LEFT JOIN users u ON u.id = r.user_id
+            WHERE r.day BETWEEN ? AND ?
+            GROUP BY r.user_id
+            ORDER BY SUM(r.prompt_tokens + r.completion_tokens) DESC
+            LIMIT ?""",
+        (day_from, day_to, limit),
     )
-    conn.commit()
-    conn.close()
+    return cur.fetchall()
+
+
+def insert_alert(title: str, body: str):
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            "INSERT INTO regulatory_alerts (title, body, created_at) VALUES (?, ?, ?)",
+            (title, body, _now()),
+        )
 
 
 def list_alerts(limit: int = 10):
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
+    cur = conn.execute(
         "SELECT * FROM regulatory_alerts ORDER BY created_at DESC LIMIT ?",
         (limit,),
     )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+    return cur.fetchall()
 
 
 # --------------------------------------------------------------
@@ -290,69 +1306,100 @@ def list_alerts(limit: int = 10):
 def set_user_admin(chat_id: int, is_admin: bool = True):
     """Mark a user as admin (or remove admin)."""
     conn = get_connection()
-    cur = conn.cursor()
-
-    cur.execute("SELECT id FROM users WHERE chat_id = ?", (chat_id,))
-    row = cur.fetchone()
-
-    if row:
-        cur.execute(
-            "UPDATE users SET is_admin = ? WHERE chat_id = ?",
-            (1 if is_admin else 0, chat_id),
-        )
-    else:
-        cur.execute(
-            """INSERT INTO users
-               (chat_id, username, full_name, free_messages, is_premium,
-                is_admin, created_at, last_seen)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
-            (chat_id, None, None, 150, 0, 1 if is_admin else 0, _now(), _now()),
-        )
+    with conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM users WHERE chat_id = ?", (chat_id,))
+        row = cur.fetchone()
 
-    conn.commit()
-    conn.close()
+        if row:
+            cur.execute(
+                "UPDATE users SET is_admin = ? WHERE chat_id = ?",
+                (1 if is_admin else 0, chat_id),
+            )
+        else:
+            cur.execute(
+                """INSERT INTO users
+                   (chat_id, username, full_name, free_messages, is_premium,
+                    is_admin, created_at, last_seen)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                (chat_id, None, None, 150, 0, 1 if is_admin else 0, _now(), _now()),
+            )
+    invalidate_user(chat_id=chat_id)
 
 
 def get_all_users():
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users ORDER BY created_at ASC")
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+    cur = conn.execute("SELECT * FROM users ORDER BY created_at ASC")
+    return cur.fetchall()
+
+
+# Admin listings use keyset pagination on (last_seen, id), newest first.
+# Pass the last row of a page as ``after`` to fetch the next one.
+USER_PAGE_SIZE = 500
 
 
-def list_users_by_premium(is_premium: int):
-    """Returns list of subscribed (1) or unsubscribed (0) users."""
+# Users who never sent a message have last_seen NULL; the listings sort
+# and page on COALESCE(last_seen, '') so they come last instead of being
+# skipped by the keyset comparison.
+_USER_ORDER = " ORDER BY COALESCE(last_seen, '') DESC, id DESC LIMIT ?"
+
+
+def _keyset(after):
+    if after is None:
+        return "", ()
+    return (" AND (COALESCE(last_seen, ''), id) < (?, ?)",
+            (after["last_seen"] or "", after["id"]))
+
+
+def list_users_by_premium(is_premium: int, limit: int = USER_PAGE_SIZE, after=None):
+    """Returns one page of subscribed (1) or unsubscribed (0) users."""
+    extra, params = _keyset(after)
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT * FROM users WHERE is_premium = ? ORDER BY last_seen DESC",
-        (is_premium,),
+    cur = conn.execute(
+        "SELECT * FROM users WHERE is_premium = ?" + extra +
+        _USER_ORDER,
+        (is_premium, *params, limit),
     )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+    return cur.fetchall()
 
 
-def list_online_users(minutes: int = 15):
-    """Users active in the last N minutes."""
-    all_users = get_all_users()
-    now = datetime.utcnow()
-    cutoff = now - timedelta(minutes=minutes)
+def count_users_by_premium(is_premium: int) -> int:
+    conn = get_connection()
+    cur = conn.execute("SELECT COUNT(*) FROM users WHERE is_premium = ?", (is_premium,))
+    return cur.fetchone()[0]
 
-    result = []
-    for u in all_users:
-        last = u["last_seen"]
-        if not last:
-            continue
 
-        try:
-            dt = datetime.fromisoformat(last)
-        except Exception:
-            continue
+def _online_cutoff(minutes: int) -> str:
+    return (datetime.utcnow() - timedelta(minutes=minutes)).isoformat(timespec="seconds")
+
+
+def list_online_users(minutes: int = 15, limit: int = USER_PAGE_SIZE, after=None):
+    """One page of users active in the last N minutes."""
+    extra, params = _keyset(after)
+    conn = get_connection()
+    cur = conn.execute(
+        "SELECT * FROM users WHERE last_seen >= ?" + extra +
+        _USER_ORDER,
+        (_online_cutoff(minutes), *params, limit),
+    )
+    return cur.fetchall()
+
+
+def count_online_users(minutes: int = 15) -> int:
+    conn = get_connection()
+    cur = conn.execute(
+        "SELECT COUNT(*) FROM users WHERE last_seen >= ?",
+        (_online_cutoff(minutes),),
+    )
+    return cur.fetchone()[0]
 
-        if dt >= cutoff:
-            result.append(u)
 
-    return result
+def iter_pages(list_func, *args, page_size: int = USER_PAGE_SIZE):
+    """Yield rows from a keyset-paginated list_* function, page by page."""
+    after = None
+    while True:
+        rows = list_func(*args, limit=page_size, after=after)
+        yield from rows
+        if len(rows) < page_size:
+            return
+        after = rows[-1]
@@ -0,0 +1,309 @@
+"""
+Pre-extracted PDF text, keyed by content hash.
+
+As soon as a PDF is uploaded, its text is extracted and chunked in the
+background into a gzip'd JSON-lines sidecar,
+EXTRACT_CACHE_DIR/<sha256>.jsonl.gz:
+
+    {"version": 1, "sha256": ..., "pages": N, "max_chars": 1200}
+    [chunk_index, content, token_count, page_start, page_end]
+    ...
+    {"end": true, "chunks": M}
+
+The file is written under a temporary name and renamed when complete.
+Approval then only bulk-inserts the prepared chunks, and a document can
+be re-indexed without parsing the PDF again.
+
+    python extract_cache.py --build FILE.pdf ...
+    python extract_cache.py --reindex DOC_ID
+    python extract_cache.py --selftest
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterator, Optional, Tuple
+
+from config import (
+    BOOKS_FOLDER,
+    EXTRACT_CACHE_DIR,
+    EXTRACT_PREFETCH_ENABLED,
+    INGEST_BATCH_CHUNKS,
+)
+from database import (
+    init_db,
+    get_document,
+    set_document_hash,
+    set_document_pages,
+    replace_document_chunks,
+)
+from pdf_ingest import (
+    CHUNK_MAX_CHARS,
+    chunk_rows,
+    iter_chunks,
+    iter_pdf_pages,
+    pdf_page_count,
+    sha256_file,
+    _update_vector_index,
+)
+
+logger = logging.getLogger(__name__)
+
+SIDECAR_VERSION = 1
+
+_executor = None
+_inflight = {}      # sha256 -> Future of a running prefetch
+_lock = threading.Lock()
+
+
+def sidecar_path(content_sha256: str) -> str:
+    return os.path.join(EXTRACT_CACHE_DIR, f"{content_sha256}.jsonl.gz")
+
+
+def load_header(content_sha256: str) -> Optional[dict]:
+    """Header of a complete, current-format sidecar, or None."""
+    path = sidecar_path(content_sha256)
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            header = json.loads(f.readline())
+    except (OSError, EOFError, ValueError, zlib.error):
+        return None
+    if header.get("version") != SIDECAR_VERSION or header.get("max_chars") != CHUNK_MAX_CHARS:
+        return None
+    return header
+
+
+def build_sidecar(content_sha256: str, pdf_path: str, workers: Optional[int] = None) -> dict:
+    """Extract and chunk ``pdf_path`` into its sidecar. Returns the header
+    plus ``chunks``."""
+    os.makedirs(EXTRACT_CACHE_DIR, exist_ok=True)
+    header = {
+        "version": SIDECAR_VERSION,
+        "sha256": content_sha256,
+        "pages": pdf_page_count(pdf_path),
+        "max_chars": CHUNK_MAX_CHARS,
+    }
+    path = sidecar_path(content_sha256)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    chunks = 0
+    try:
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            f.write(json.dumps(header) + "\n")
+            for row in chunk_rows(iter_chunks(iter_pdf_pages(pdf_path, workers=workers))):
+                f.write(json.dumps(row, ensure_ascii=False) + "\n")
+                chunks += 1
+            f.write(json.dumps({"end": True, "chunks": chunks}) + "\n")
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return dict(header, chunks=chunks)
+
+
+def iter_rows(content_sha256: str) -> Iterator[Tuple[int, str, int, int, int]]:
+    """Yield add_document_chunks rows from a sidecar, streaming.
+
+    Raises ValueError if the file is truncated or corrupt. The gzip CRC is
+    only checked at end of stream, so the last row is followed by reading
+    to EOF: consume the whole iterator (inside one transaction) before
+    trusting any of the rows.
+    """
+    try:
+        with gzip.open(sidecar_path(content_sha256), "rt", encoding="utf-8") as f:
+            f.readline()
+            count = 0
+            for line in f:
+                row = json.loads(line)
+                if isinstance(row, dict):
+                    if row.get("end"):
+                        if f.read() or row.get("chunks") != count:
+                            break
+                        return
+                    continue
+                count += 1
+                yield tuple(row)
+    except (OSError, EOFError, zlib.error) as e:
+        raise ValueError(f"Sidecar for {content_sha256} is unreadable: {e}") from e
+    raise ValueError(f"Sidecar for {content_sha256} is truncated or corrupt")
+
+
+# ==========================================================
+# BACKGROUND PREFETCH
+# ==========================================================
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        # One upload at a time, each read serially (workers=1 below):
+        # extraction is CPU-heavy and competes with the bot
+        _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="extract-prefetch")
+    return _executor
+
+
+def _prefetch_job(doc_id: int, content_sha256: str, pdf_path: str):
+    started = time.perf_counter()
+    try:
+        set_document_pages(doc_id, pdf_page_count(pdf_path))
+        if load_header(content_sha256) is None:
+            header = build_sidecar(content_sha256, pdf_path, workers=1)
+            logger.info("Pre-extracted document %s: %d pages, %d chunks in %.1fs",
+                        doc_id, header["pages"], header["chunks"],
+                        time.perf_counter() - started)
+    except Exception:
+        logger.exception("Pre-extraction of document %s failed", doc_id)
+        raise
+    finally:
+        with _lock:
+            _inflight.pop(content_sha256, None)
+
+
+def prefetch(doc_id: int, content_sha256: str, pdf_path: str) -> Optional[Future]:
+    """Queue background extraction of a pending upload (no-op if its
+    sidecar exists or is already being built)."""
+    if not EXTRACT_PREFETCH_ENABLED:
+        return None
+    with _lock:
+        future = _inflight.get(content_sha256)
+        if future is not None:
+            return future
+        header = load_header(content_sha256)
+        if header is not None:
+            set_document_pages(doc_id, header["pages"])
+            return None
+        future = _get_executor().submit(_prefetch_job, doc_id, content_sha256, pdf_path)
+        _inflight[content_sha256] = future
+        return future
+
+
+def wait_for_prefetch(content_sha256: str, timeout: Optional[float] = None):
+    """Block until a running prefetch of this content (if any) finishes."""
+    with _lock:
+        future = _inflight.get(content_sha256)
+    if future is None:
+        return
+    try:
+        future.result(timeout=timeout)
+    except Exception:
+        pass    # already logged; the caller falls back to parsing
+
+
+def stop_prefetch():
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+# ==========================================================
+# RE-INDEX FROM SIDECAR
+# ==========================================================
+def reindex_document(doc_id: int) -> int:
+    """Replace an approved document's chunks from its sidecar (building
+    the sidecar from the PDF once if needed). Returns chunks written."""
+    doc = get_document(doc_id)
+    if doc is None:
+        raise ValueError(f"Document {doc_id} not found")
+    content_sha256 = doc["content_sha256"]
+    pdf_path = os.path.join(BOOKS_FOLDER, doc["filename"])
+    if content_sha256 is None:
+        content_sha256 = sha256_file(pdf_path)
+        set_document_hash(doc_id, content_sha256)
+    if load_header(content_sha256) is None:
+        build_sidecar(content_sha256, pdf_path)
+
+    old_ids, written = replace_document_chunks(doc_id, iter_rows(content_sha256),
+                                               batch_size=INGEST_BATCH_CHUNKS)
+    _update_vector_index(doc_id, replaced_chunk_ids=old_ids)
+    return written
+
+
+# ==========================================================
+# SELF-TEST
+# ==========================================================
+def selftest():
+    """A sidecar that fails part-way through an approval, with the ingest
+    job's progress callback attached, must leave the old chunks intact.
+    Runs against a throwaway database and cache directory."""
+    import tempfile
+    import database
+    import extract_cache as cache   # the module pdf_approval reads from, also under __main__
+    from pdf_approval import _insert_prepared_chunks
+
+    with tempfile.TemporaryDirectory() as folder:
+        database.close_connection()
+        database.DB_PATH = os.path.join(folder, "selftest.db")
+        cache.EXTRACT_CACHE_DIR = os.path.join(folder, "extract_cache")
+        init_db()
+        doc_id = database.insert_document("selftest", "selftest.pdf", 3, 1, "pending")
+        database.add_document_chunks(doc_id, [(i, f"old chunk {i}", 3) for i in range(3)])
+        job_id = database.create_ingest_job(doc_id, 1)
+        old = [tuple(r) for r in database.get_connection().execute(
+            "SELECT id, chunk_index, content FROM document_chunks WHERE document_id = ?", (doc_id,))]
+
+        def progress(pages_done, pages_total, chunks_done):
+            database.update_ingest_progress(job_id, pages_total, pages_done, chunks_done)
+
+        # More than two insert batches, then the file just stops (no end marker)
+        rows = INGEST_BATCH_CHUNKS * 2 + 50
+        sha = "0" * 64
+        os.makedirs(cache.EXTRACT_CACHE_DIR)
+        with gzip.open(cache.sidecar_path(sha), "wt", encoding="utf-8") as f:
+            f.write(json.dumps({"version": SIDECAR_VERSION, "sha256": sha, "pages": rows,
+                                "max_chars": CHUNK_MAX_CHARS}) + "\n")
+            for i in range(rows):
+                f.write(json.dumps([i, f"new chunk {i}", 3, i + 1, i + 1]) + "\n")
+        try:
+            _insert_prepared_chunks(doc_id, sha, rows, progress)
+        except ValueError as e:
+            assert "truncated" in str(e), e
+            print("truncated sidecar rejected")
+        else:
+            raise AssertionError("truncated sidecar was accepted")
+        now = [tuple(r) for r in database.get_connection().execute(
+            "SELECT id, chunk_index, content FROM document_chunks WHERE document_id = ?", (doc_id,))]
+        assert now == old, f"old chunks lost: {len(now)} rows now"
+        print(f"old chunks intact ({len(old)} rows) after {rows} rows were read")
+
+        with gzip.open(cache.sidecar_path(sha), "at", encoding="utf-8") as f:
+            f.write(json.dumps({"end": True, "chunks": rows}) + "\n")
+        _, written = _insert_prepared_chunks(doc_id, sha, rows, progress)
+        job = database.get_connection().execute(
+            "SELECT chunks_done FROM ingest_jobs WHERE id = ?", (job_id,)).fetchone()
+        assert written == rows and job["chunks_done"] == rows, (written, job["chunks_done"])
+        print(f"complete sidecar swapped in: {written} chunks, job progress saved")
+        database.close_connection()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Pre-extracted PDF chunk cache")
+    parser.add_argument("--build", nargs="+", metavar="PDF", help="build sidecars for PDFs")
+    parser.add_argument("--reindex", type=int, metavar="DOC_ID",
+                        help="re-insert a document's chunks from its sidecar")
+    parser.add_argument("--selftest", action="store_true",
+                        help="check that a failed chunk swap keeps the old chunks")
+    args = parser.parse_args()
+    if args.build:
+        for pdf in args.build:
+            started = time.perf_counter()
+            sha = sha256_file(pdf)
+            header = build_sidecar(sha, pdf)
+            print(f"{pdf}: {header['pages']} pages, {header['chunks']} chunks, "
+                  f"{os.path.getsize(sidecar_path(sha)) / 1024:.0f} KiB "
+                  f"in {time.perf_counter() - started:.1f}s")
+    elif args.reindex is not None:
+        init_db()
+        started = time.perf_counter()
+        print(f"Document {args.reindex}: {reindex_document(args.reindex)} chunks "
+              f"in {time.perf_counter() - started:.1f}s")
+    elif args.selftest:
+        selftest()
+    else:
+        parser.print_help()
@@ -0,0 +1,144 @@
+"""
+Background PDF ingestion.
+
+Approving a PDF only queues a job in the ingest_jobs table. A single
+worker thread extracts, chunks and indexes queued documents one at a
+time and reports progress (pages, chunks, elapsed time) through a
+notifier, which the bot uses to edit the approving admin's status
+message. Jobs left running by a restart are queued again at startup and
+resume after the last committed page.
+"""
+
+import logging
+import threading
+import time
+from typing import Callable, Optional, Tuple
+
+from config import INGEST_PROGRESS_INTERVAL_SECONDS, INGEST_POLL_SECONDS
+from database import (
+    create_ingest_job,
+    get_active_ingest_job,
+    claim_next_ingest_job,
+    update_ingest_progress,
+    finish_ingest_job,
+    requeue_interrupted_ingest_jobs,
+    close_connection,
+)
+from pdf_approval import check_pending_pdf, approve_pending_pdf
+
+logger = logging.getLogger(__name__)
+
+# notify(job_row, text, final) -> None
+Notifier = Callable[[object, str, bool], None]
+
+_worker = None
+_notify: Optional[Notifier] = None
+_stop = threading.Event()
+_wake = threading.Event()
+_enqueue_lock = threading.Lock()
+
+
+def enqueue_pdf_approval(doc_id: int, admin_user_id: int, chat_id: int = None,
+                         status_message_id: int = None) -> Tuple[bool, str]:
+    """Queue a pending PDF for background ingestion. Progress is reported
+    by editing ``status_message_id`` in ``chat_id``."""
+    with _enqueue_lock:
+        ok, msg = check_pending_pdf(doc_id)
+        if not ok:
+            return False, msg
+        active = get_active_ingest_job(doc_id)
+        if active:
+            return False, f"Document {doc_id} is already being ingested (job {active['id']})."
+        job_id = create_ingest_job(doc_id, admin_user_id, chat_id, status_message_id)
+    _wake.set()
+    return True, f"Document {doc_id} queued for ingestion (job {job_id})."
+
+
+def progress_text(doc_id: int, pages_done: int, pages_total: int,
+                  chunks_done: int, elapsed: float) -> str:
+    percent = 100 * pages_done // pages_total if pages_total else 0
+    return (
+        f"⏳ Ingesting PDF {doc_id}: page {pages_done}/{pages_total} ({percent}%)\n"
+        f"Chunks indexed: {chunks_done}\n"
+        f"Elapsed: {elapsed:.0f}s"
+    )
+
+
+def _send(job, text: str, final: bool = False):
+    if _notify is None:
+        return
+    try:
+        _notify(job, text, final)
+    except Exception:
+        logger.exception("Failed to report progress of ingestion job %s", job["id"])
+
+
+def _run_job(job):
+    doc_id = job["document_id"]
+    started = time.monotonic()
+    last_report = 0.0
+    if job["attempts"] > 1:
+        _send(job, f"⏳ Resuming ingestion of PDF {doc_id} after restart…")
+
+    # Called after each committed batch of chunks (never from inside a
+    # chunk transaction), so saving progress cannot commit half a document
+    def progress(pages_done, pages_total, chunks_done):
+        nonlocal last_report
+        update_ingest_progress(job["id"], pages_total, pages_done, chunks_done)
+        now = time.monotonic()
+        if now - last_report >= INGEST_PROGRESS_INTERVAL_SECONDS:
+            last_report = now
+            _send(job, progress_text(doc_id, pages_done, pages_total, chunks_done, now - started))
+
+    try:
+        ok, msg = approve_pending_pdf(doc_id, job["admin_user_id"], progress=progress)
+    except Exception as e:
+        logger.exception("Ingestion job %s (document %s) failed", job["id"], doc_id)
+        ok, msg = False, f"Ingestion of PDF {doc_id} failed: {e}"
+
+    elapsed = time.monotonic() - started
+    finish_ingest_job(job["id"], "done" if ok else "failed", None if ok else msg)
+    logger.info("Ingestion job %s finished in %.1fs: %s", job["id"], elapsed, msg)
+    _send(job, f"{'✅' if ok else '❌'} {msg} ({elapsed:.0f}s)", final=True)
+
+
+def _worker_loop():
+    while not _stop.is_set():
+        _wake.clear()
+        try:
+            job = claim_next_ingest_job()
+        except Exception:
+            logger.exception("Failed to claim an ingestion job")
+            job = None
+        if job is None:
+            _wake.wait(INGEST_POLL_SECONDS)
+            continue
+        _run_job(job)
+    close_connection()
+
+
+def start_ingest_worker(notify: Optional[Notifier] = None):
+    """Re-queue interrupted jobs and start the worker thread."""
+    global _worker, _notify
+    _notify = notify
+    if _worker and _worker.is_alive():
+        return
+    requeued = requeue_interrupted_ingest_jobs()
+    if requeued:
+        logger.info("Re-queued %d interrupted ingestion job(s)", requeued)
+    _stop.clear()
+    _worker = threading.Thread(target=_worker_loop, name="ingest-worker", daemon=True)
+    _worker.start()
+
+
+def stop_ingest_worker(timeout: float = 5):
+    """Stop taking new jobs. A job still running is left 'running' and
+    resumes on the next start."""
+    global _worker
+    worker = _worker
+    if worker is None:
+        return
+    _stop.set()
+    _wake.set()
+    worker.join(timeout=timeout)
+    _worker = None
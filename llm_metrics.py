@@ -0,0 +1,208 @@
+"""
+Per-call LLM instrumentation.
+
+Every upstream call records queue wait, connect time, time to first byte,
+total latency, prompt/completion tokens and the entry point that made it.
+Latencies go into in-memory histograms (since process start); tokens and
+call counts are accumulated per (day, user, entry point) and flushed to
+the llm_usage_daily table periodically.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import llm_scheduler
+from config import LLM_PRICE_PROMPT_PER_1M, LLM_PRICE_COMPLETION_PER_1M
+from database import add_llm_usage, top_llm_consumers
+
+# Histogram bucket upper bounds in ms (last bucket is open-ended)
+BUCKETS_MS = [
+    5, 10, 25, 50, 100, 250, 500, 750, 1000, 1500, 2000, 3000, 5000,
+    7500, 10000, 15000, 20000, 30000, 45000, 60000, 90000, 120000, 180000,
+]
+
+METRICS = ("queue_wait_ms", "connect_ms", "ttfb_ms", "total_ms")
+
+
+class Histogram:
+    """Fixed-bucket latency histogram with interpolated percentiles."""
+
+    def __init__(self, bounds: List[float] = BUCKETS_MS):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, pct: float) -> float:
+        if not self.total:
+            return 0.0
+        target = pct / 100.0 * self.total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= target:
+                low = self.bounds[i - 1] if i > 0 else 0.0
+                high = self.bounds[i] if i < len(self.bounds) else self.max
+                return min(low + (high - low) * (target - seen) / count, self.max)
+            seen += count
+        return self.max
+
+
+@dataclass
+class LLMCall:
+    entry_point: str
+    user_id: Optional[int] = None
+    queue_wait_ms: float = 0.0
+    connect_ms: float = 0.0
+    ttfb_ms: float = 0.0
+    total_ms: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    ok: bool = True
+    started: float = field(default_factory=time.perf_counter)
+    _marks: Dict[str, float] = field(default_factory=dict, repr=False)
+
+    def trace(self, event_name: str, info: dict):
+        """httpcore trace hook (request.extensions["trace"]).
+
+        Only the last attempt counts if the request was retried.
+        """
+        now = time.perf_counter()
+        if event_name == "connection.connect_tcp.started":
+            self._marks.clear()
+        self._marks[event_name] = now
+        m = self._marks
+        if event_name in ("connection.connect_tcp.complete", "connection.start_tls.complete"):
+            if "connection.connect_tcp.started" in m:
+                self.connect_ms = (now - m["connection.connect_tcp.started"]) * 1000
+        elif event_name.endswith("receive_response_headers.complete"):
+            sent = next((v for k, v in m.items() if k.endswith("send_request_headers.started")), None)
+            if sent is not None:
+                self.ttfb_ms = (now - sent) * 1000
+
+
+_local = threading.local()
+_lock = threading.Lock()
+_histograms = {name: Histogram() for name in METRICS}
+_by_entry = {}          # entry_point -> Histogram of total_ms
+_pending_rollup = {}    # (day, user_id, entry_point) -> [calls, errors, prompt, completion, latency]
+
+
+@contextmanager
+def request_context(user_id: Optional[int]):
+    """Attribute LLM calls made in this block (on this thread) to a user."""
+    previous = getattr(_local, "ctx", None)
+    _local.ctx = {"user_id": user_id}
+    try:
+        yield
+    finally:
+        _local.ctx = previous
+
+
+def propagate(fn):
+    """Wrap ``fn`` so that, run on another thread, its LLM calls are
+    attributed and admitted (llm_scheduler) like calls made on the
+    current thread."""
+    contexts = (_local, llm_scheduler.admission_local)
+    saved = [getattr(local, "ctx", None) for local in contexts]
+
+    def run(*args, **kwargs):
+        previous = [getattr(local, "ctx", None) for local in contexts]
+        for local, ctx in zip(contexts, saved):
+            local.ctx = ctx
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            for local, ctx in zip(contexts, previous):
+                local.ctx = ctx
+    return run
+
+
+def start_call(entry_point: str, queue_wait: float = 0.0) -> LLMCall:
+    """Start timing an upstream call; ``queue_wait`` is the seconds it
+    waited for an admission slot."""
+    ctx = getattr(_local, "ctx", None) or {}
+    return LLMCall(
+        entry_point=entry_point,
+        user_id=ctx.get("user_id"),
+        queue_wait_ms=queue_wait * 1000,
+    )
+
+
+def finish_call(call: LLMCall, ok: bool = True):
+    call.ok = ok
+    call.total_ms = (time.perf_counter() - call.started) * 1000
+    day = datetime.utcnow().strftime("%Y-%m-%d")
+    key = (day, call.user_id, call.entry_point)
+    with _lock:
+        for name in METRICS:
+            _histograms[name].record(getattr(call, name))
+        _by_entry.setdefault(call.entry_point, Histogram()).record(call.total_ms)
+        agg = _pending_rollup.setdefault(key, [0, 0, 0, 0, 0.0])
+        agg[0] += 1
+        agg[1] += 0 if ok else 1
+        agg[2] += call.prompt_tokens
+        agg[3] += call.completion_tokens
+        agg[4] += call.total_ms
+
+
+def flush_rollup() -> int:
+    """Write accumulated usage to llm_usage_daily. Returns rows written."""
+    with _lock:
+        if not _pending_rollup:
+            return 0
+        pending = dict(_pending_rollup)
+        _pending_rollup.clear()
+    # user_id 0 = not attributed (NULL would defeat the primary-key upsert)
+    rows = [(day, user or 0, entry, *agg) for (day, user, entry), agg in pending.items()]
+    try:
+        add_llm_usage(rows)
+    except Exception:
+        with _lock:
+            for key, agg in pending.items():
+                cur = _pending_rollup.setdefault(key, [0, 0, 0, 0, 0.0])
+                for i, v in enumerate(agg):
+                    cur[i] += v
+        raise
+    return len(rows)
+
+
+def cost_usd(prompt_tokens: int, completion_tokens: int) -> float:
+    return (prompt_tokens * LLM_PRICE_PROMPT_PER_1M
+            + completion_tokens * LLM_PRICE_COMPLETION_PER_1M) / 1_000_000
+
+
+def latency_summary() -> dict:
+    """{metric: {"count", "p50", "p95", "p99", "max"}} plus per entry point totals."""
+    def summarize(h: Histogram) -> dict:
+        return {"count": h.total, "p50": h.percentile(50), "p95": h.percentile(95),
+                "p99": h.percentile(99), "max": h.max}
+
+    with _lock:
+        summary = {name: summarize(h) for name, h in _histograms.items()}
+        summary["by_entry_point"] = {e: summarize(h) for e, h in _by_entry.items()}
+    return summary
+
+
+def top_consumers(days: int = 1, limit: int = 10):
+    """Top token users over the last ``days`` days (UTC), with cost."""
+    flush_rollup()
+    today = datetime.utcnow().date()
+    day_from = (today - timedelta(days=days - 1)).isoformat()
+    result = []
+    for row in top_llm_consumers(day_from, today.isoformat(), limit):
+        item = dict(row)
+        item["cost_usd"] = cost_usd(row["prompt_tokens"], row["completion_tokens"])
+        result.append(item)
+    return result
@@ -0,0 +1,456 @@
+"""
+Routing across several OpenAI-compatible LLM endpoints.
+
+- The primary endpoint (LLM_API_BASE) is tried first, then
+  LLM_FALLBACK_ENDPOINTS in configured order.
+- Each endpoint keeps a rolling window of recent calls (latency, ok).
+  An endpoint whose error rate is above LLM_ENDPOINT_MAX_ERROR_RATE, or
+  that failed LLM_ENDPOINT_FAILURE_THRESHOLD times in a row, is put on
+  cooldown and only used when nothing healthier is left.
+- A failed request moves on to the next endpoint straight away. Only
+  connection errors, timeouts, 401/403/404 (that endpoint's key, model or
+  URL), 429 and 5xx count as endpoint failures; other 4xx responses (e.g.
+  a prompt that is too long) are the request's fault and go straight back
+  to the caller.
+- With LLM_HEDGE_ENABLED, a request that has no response headers from its
+  endpoint within that endpoint's p95 (at least LLM_HEDGE_MIN_DELAY_SECONDS)
+  is also sent to the next endpoint; whichever answers first wins and the
+  other response is closed. The extra request needs a free llm_scheduler
+  slot; if there is none, the request is not hedged.
+
+Stub-server self-test:  python llm_router.py --selftest
+"""
+
+import argparse
+import json
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, List, Optional
+
+import llm_scheduler
+from config import (
+    LLM_API_BASE,
+    LLM_API_KEY,
+    LLM_MODEL_NAME,
+    LLM_MAX_CONNECTIONS,
+    LLM_FALLBACK_ENDPOINTS,
+    LLM_ROUTER_WINDOW,
+    LLM_ENDPOINT_MAX_ERROR_RATE,
+    LLM_ENDPOINT_FAILURE_THRESHOLD,
+    LLM_ENDPOINT_COOLDOWN_SECONDS,
+    LLM_HEDGE_ENABLED,
+    LLM_HEDGE_MIN_DELAY_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Fewer samples than this and an endpoint's percentiles are not trusted
+MIN_SAMPLES = 5
+
+# Client errors that point at one endpoint's configuration (API key,
+# model name, URL), so another endpoint may well succeed
+ENDPOINT_STATUS_CODES = {401, 403, 404, 429}
+
+
+def is_endpoint_failure(exc: BaseException) -> bool:
+    """True if ``exc`` means the endpoint is unhealthy or misconfigured
+    rather than the request invalid: anything without an HTTP response
+    (connection errors, timeouts), ENDPOINT_STATUS_CODES or 5xx."""
+    status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status is None or status in ENDPOINT_STATUS_CODES or status >= 500
+
+
+class Endpoint:
+    def __init__(self, name: str, url: str, api_key: str, model: str,
+                 window: int = LLM_ROUTER_WINDOW):
+        self.name = name
+        self.url = url
+        self.api_key = api_key
+        self.model = model
+        self._samples = deque(maxlen=window)   # (latency_seconds, ok)
+        self._consecutive_failures = 0
+        self._cooldown_until = 0.0
+        self._requests = 0
+        self._lock = threading.Lock()
+
+    def record(self, latency: float, ok: bool, now: float,
+               failure_threshold: int, max_error_rate: float, cooldown: float):
+        with self._lock:
+            self._requests += 1
+            self._samples.append((latency, ok))
+            if ok:
+                self._consecutive_failures = 0
+                return
+            self._consecutive_failures += 1
+            if (self._consecutive_failures >= failure_threshold
+                    or (len(self._samples) >= MIN_SAMPLES
+                        and self._error_rate() > max_error_rate)):
+                if self._cooldown_until <= now:
+                    logger.warning("LLM endpoint %s on cooldown for %.0fs", self.name, cooldown)
+                self._cooldown_until = now + cooldown
+
+    def _error_rate(self) -> float:
+        if not self._samples:
+            return 0.0
+        return sum(1 for _, ok in self._samples if not ok) / len(self._samples)
+
+    def healthy(self, now: float) -> bool:
+        with self._lock:
+            return self._cooldown_until <= now
+
+    def latency_percentile(self, pct: float) -> Optional[float]:
+        """Percentile of successful call latency (seconds), or None."""
+        with self._lock:
+            values = sorted(lat for lat, ok in self._samples if ok)
+        if len(values) < MIN_SAMPLES:
+            return None
+        return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+    def stats(self, now: float) -> dict:
+        p50 = self.latency_percentile(50)
+        p95 = self.latency_percentile(95)
+        with self._lock:
+            return {
+                "name": self.name,
+                "requests": self._requests,
+                "error_rate": self._error_rate(),
+                "p50_ms": p50 * 1000 if p50 is not None else None,
+                "p95_ms": p95 * 1000 if p95 is not None else None,
+                "cooldown_s": max(0.0, self._cooldown_until - now),
+            }
+
+
+class LLMRouter:
+    def __init__(self, endpoints: List[Endpoint],
+                 hedge: bool = LLM_HEDGE_ENABLED,
+                 hedge_min_delay: float = LLM_HEDGE_MIN_DELAY_SECONDS,
+                 failure_threshold: int = LLM_ENDPOINT_FAILURE_THRESHOLD,
+                 max_error_rate: float = LLM_ENDPOINT_MAX_ERROR_RATE,
+                 cooldown: float = LLM_ENDPOINT_COOLDOWN_SECONDS,
+                 clock: Callable[[], float] = time.monotonic):
+        if not endpoints:
+            raise ValueError("LLMRouter needs at least one endpoint")
+        self.endpoints = list(endpoints)
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.failure_threshold = failure_threshold
+        self.max_error_rate = max_error_rate
+        self.cooldown = cooldown
+        self.clock = clock
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {"requests": 0, "failovers": 0, "hedged": 0, "hedge_wins": 0}
+
+    @classmethod
+    def from_config(cls) -> "LLMRouter":
+        endpoints = [Endpoint("primary", LLM_API_BASE, LLM_API_KEY, LLM_MODEL_NAME)]
+        for i, cfg in enumerate(LLM_FALLBACK_ENDPOINTS, start=1):
+            endpoints.append(Endpoint(
+                cfg.get("name") or f"fallback{i}",
+                cfg["url"],
+                cfg.get("api_key", LLM_API_KEY),
+                cfg.get("model", LLM_MODEL_NAME),
+            ))
+        return cls(endpoints)
+
+    def _bump(self, key: str):
+        with self._stats_lock:
+            self._stats[key] += 1
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=LLM_MAX_CONNECTIONS,
+                                                    thread_name_prefix="llm-hedge")
+        return self._pool
+
+    def ordered(self) -> List[Endpoint]:
+        """Healthy endpoints in configured order, then those on cooldown."""
+        now = self.clock()
+        healthy = [e for e in self.endpoints if e.healthy(now)]
+        return healthy + [e for e in self.endpoints if e not in healthy]
+
+    def hedge_delay(self, endpoint: Endpoint) -> float:
+        p95 = endpoint.latency_percentile(95)
+        return max(self.hedge_min_delay, p95 or 0.0)
+
+    def _timed(self, send, endpoint: Endpoint, final: bool):
+        started = self.clock()
+        try:
+            result = send(endpoint, final)
+        except Exception as e:
+            # A rejected request still means the endpoint answered
+            endpoint.record(self.clock() - started, not is_endpoint_failure(e), self.clock(),
+                            self.failure_threshold, self.max_error_rate, self.cooldown)
+            raise
+        endpoint.record(self.clock() - started, True, self.clock(),
+                        self.failure_threshold, self.max_error_rate, self.cooldown)
+        return result
+
+    def _race(self, send, discard, primary: Endpoint, backup: Endpoint, final: bool):
+        """Run ``primary``; start ``backup`` too if primary is slower than
+        its hedge delay. Returns (result, endpoint) of the first success."""
+        pool = self._get_pool()
+        futures = {pool.submit(self._timed, send, primary, False): primary}
+        done, _ = wait(futures, timeout=self.hedge_delay(primary))
+        hedged = not done
+        ticket = llm_scheduler.try_extra_slot() if hedged else None
+        if hedged and ticket is None:
+            # Hedging must not push past LLM_MAX_CONCURRENCY
+            logger.info("LLM endpoint %s slow, no free slot to hedge", primary.name)
+            hedged = False
+        elif hedged:
+            logger.info("LLM endpoint %s slow, hedging to %s", primary.name, backup.name)
+            self._bump("hedged")
+            futures[pool.submit(self._timed, send, backup, final)] = backup
+            # The extra slot is held until both attempts have finished
+            _release_when_done(list(futures), lambda: llm_scheduler.scheduler.release(ticket))
+
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    if not is_endpoint_failure(error):
+                        for other in pending:
+                            other.add_done_callback(lambda f: _discard_result(f, discard))
+                        raise error
+                    if backup not in futures.values():
+                        # Not hedged: the primary's slot passes to the backup
+                        logger.warning("LLM failing over to %s (%s)", backup.name, error)
+                        self._bump("failovers")
+                        backup_future = pool.submit(self._timed, send, backup, final)
+                        futures[backup_future] = backup
+                        pending.add(backup_future)
+                    continue
+                for loser in pending:
+                    loser.add_done_callback(lambda f: _discard_result(f, discard))
+                if hedged and futures[future] is backup:
+                    self._bump("hedge_wins")
+                return future.result(), futures[future]
+        raise error
+
+    def execute(self, send: Callable[[Endpoint, bool], object],
+                discard: Optional[Callable[[object], None]] = None):
+        """Call ``send(endpoint, final)`` on endpoints until one succeeds.
+
+        ``final`` is True for the last endpoint left to try, so ``send`` can
+        spend its own retries there instead of on endpoints that have a
+        fallback. ``discard`` releases the result of a hedged request that
+        lost the race (e.g. closes a streamed response).
+        """
+        self._bump("requests")
+        candidates = self.ordered()
+        tried = set()
+        error = None
+        for i, endpoint in enumerate(candidates):
+            if endpoint.name in tried:
+                continue
+            if tried:
+                self._bump("failovers")
+                logger.warning("LLM failing over to %s (%s)", endpoint.name, error)
+            rest = [e for e in candidates[i + 1:] if e.name not in tried]
+            final = not rest
+            try:
+                if self.hedge and rest:
+                    tried.update((endpoint.name, rest[0].name))
+                    result, _ = self._race(send, discard, endpoint, rest[0],
+                                           final=len(rest) == 1)
+                else:
+                    tried.add(endpoint.name)
+                    result = self._timed(send, endpoint, final)
+                return result
+            except Exception as e:
+                if not is_endpoint_failure(e):
+                    raise
+                error = e
+        raise error
+
+    def stats(self) -> dict:
+        now = self.clock()
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["endpoints"] = [e.stats(now) for e in self.endpoints]
+        return stats
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+                self._pool = None
+
+
+def _release_when_done(futures, release):
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            release()
+    for future in futures:
+        future.add_done_callback(done)
+
+
+def _discard_result(future, discard):
+    if discard is None or future.exception() is not None:
+        return
+    try:
+        discard(future.result())
+    except Exception:
+        logger.exception("Failed to discard hedged LLM response")
+
+
+# ==========================================================
+# STUB-SERVER SELF-TEST
+# ==========================================================
+def _stub_server(delay: float = 0.0, status: int = 200, script=None):
+    """OpenAI-compatible stub answering after ``delay`` seconds. ``script``
+    is a list of ``(status, headers)`` used for the first requests; the
+    client port of every request is kept in ``Handler.ports``."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        hits = 0
+        ports = []
+        replies = list(script or [])
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            Handler.hits += 1
+            Handler.ports.append(self.client_address[1])
+            reply_status, headers = Handler.replies.pop(0) if Handler.replies else (status, {})
+            time.sleep(delay)
+            model = json.loads(body).get("model", "")
+            out = json.dumps({
+                "choices": [{"message": {"content": f"answer from {model}"}}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 3},
+            }).encode()
+            self.send_response(reply_status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+    return server, Handler, url
+
+
+def selftest(requests: int = 20):
+    """Failover past a failing or misconfigured provider, no failover for
+    a rejected request, and hedging around a slow one within the upstream
+    slot limit, using local stub servers and
+    the real ai_engine request path."""
+    import ai_engine
+
+    messages = [{"role": "user", "content": "ping"}]
+
+    def run(router, label):
+        ai_engine.set_llm_router(router)
+        latencies, answers = [], {}
+        for _ in range(requests):
+            started = time.perf_counter()
+            text = ai_engine._run_completion(messages, entry_point="selftest")
+            latencies.append((time.perf_counter() - started) * 1000)
+            answers[text] = answers.get(text, 0) + 1
+        latencies.sort()
+        print(f"{label}: p50 {latencies[len(latencies) // 2]:.0f} ms,"
+              f" p95 {latencies[int(len(latencies) * 0.95) - 1]:.0f} ms, answers {answers}")
+        for e in router.stats()["endpoints"]:
+            print(f"    {e['name']:5s} requests {e['requests']:3d}"
+                  f"  error rate {e['error_rate']:.0%}  cooldown {e['cooldown_s']:.0f}s")
+        return router
+
+    servers = []
+    try:
+        down = _stub_server(status=503)
+        slow = _stub_server(delay=0.8)
+        fast = _stub_server(delay=0.02)
+        servers = [down[0], slow[0], fast[0]]
+
+        def endpoint(name, stub):
+            return Endpoint(name, stub[2], "test", name)
+
+        # Failing primary: retries are skipped while a fallback exists and
+        # the primary goes on cooldown after a few failures.
+        router = run(LLMRouter([endpoint("down", down), endpoint("fast", fast)], hedge=False),
+                     "failover (down -> fast)")
+        print(f"    'down' was hit {down[1].hits} times for {requests} requests,"
+              f" {router.stats()['failovers']} failovers")
+
+        # A request the provider rejects (413) is the caller's problem: it
+        # is not replayed on the fallback and does not demote the endpoint.
+        rejecting = _stub_server(status=413)
+        servers.append(rejecting[0])
+        fast_hits = fast[1].hits
+        router = LLMRouter([endpoint("413", rejecting), endpoint("fast", fast)], hedge=False)
+        ai_engine.set_llm_router(router)
+        rejected = 0
+        for _ in range(requests):
+            try:
+                ai_engine._run_completion(messages, entry_point="selftest")
+            except Exception as e:
+                rejected += getattr(getattr(e, "response", None), "status_code", None) == 413
+        primary = router.stats()["endpoints"][0]
+        print(f"rejected request (413): {rejected}/{requests} raised to the caller,"
+              f" fallback hit {fast[1].hits - fast_hits} times,"
+              f" primary cooldown {primary['cooldown_s']:.0f}s")
+
+        # A revoked key (401) is that endpoint's problem: fail over.
+        unauthorized = _stub_server(status=401)
+        servers.append(unauthorized[0])
+        run(LLMRouter([endpoint("401", unauthorized), endpoint("fast", fast)], hedge=False),
+            "failover (401 -> fast)")
+
+        run(LLMRouter([endpoint("slow", slow), endpoint("fast", fast)], hedge=False),
+            "no hedging (slow primary)")
+        router = run(LLMRouter([endpoint("slow", slow), endpoint("fast", fast)],
+                               hedge=True, hedge_min_delay=0.1),
+                     "hedging   (slow primary)")
+        stats = router.stats()
+        print(f"    hedged {stats['hedged']}, won by fallback {stats['hedge_wins']}")
+
+        # With every upstream slot taken by the request itself there is no
+        # room for a hedge: the slow primary is waited for instead.
+        shared = llm_scheduler.scheduler
+        llm_scheduler.scheduler = llm_scheduler.AdmissionScheduler(max_concurrency=1)
+        try:
+            router = run(LLMRouter([endpoint("slow", slow), endpoint("fast", fast)],
+                                   hedge=True, hedge_min_delay=0.1),
+                         "hedging, 1 slot (slow primary)")
+        finally:
+            llm_scheduler.scheduler = shared
+        print(f"    hedged {router.stats()['hedged']}")
+    finally:
+        for server in servers:
+            server.shutdown()
+        ai_engine.close_http_client()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.ERROR)
+    parser = argparse.ArgumentParser(description="LLM endpoint router")
+    parser.add_argument("--selftest", action="store_true")
+    parser.add_argument("--requests", type=int, default=20)
+    args = parser.parse_args()
+    if args.selftest:
+        selftest(args.requests)
+    else:
+        parser.print_help()
@@ -0,0 +1,322 @@
+"""
+Admission control in front of the LLM.
+
+- A global cap on concurrent LLM requests (LLM_MAX_CONCURRENCY).
+- A per-user token bucket (LLM_USER_RATE_PER_MINUTE, LLM_USER_BURST), so
+  one user firing messages cannot starve everyone else.
+- Waiting requests are served from a priority queue: Lifetime Pro users
+  first, then FIFO. Waiters are told their queue position as it changes.
+- A user request is charged once (admission()); a concurrency slot is
+  only held while an upstream call is actually in flight (upstream_slot()),
+  so cache hits and coalesced followers never occupy one.
+
+Offline simulation:  python llm_scheduler.py --simulate
+"""
+
+import argparse
+import heapq
+import itertools
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+from config import (
+    LLM_MAX_CONCURRENCY,
+    LLM_USER_RATE_PER_MINUTE,
+    LLM_USER_BURST,
+    LLM_QUEUE_TIMEOUT_SECONDS,
+)
+
+PRIORITY_PREMIUM = 0
+PRIORITY_FREE = 1
+
+
+class RateLimited(Exception):
+    """The user's token bucket is empty."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limited, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class QueueTimeout(Exception):
+    """No LLM slot became free within the queue timeout."""
+
+
+class _Ticket:
+    __slots__ = ("priority", "seq", "user_id", "granted", "cancelled")
+
+    def __init__(self, priority: int, seq: int, user_id):
+        self.priority = priority
+        self.seq = seq
+        self.user_id = user_id
+        self.granted = False
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class AdmissionScheduler:
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY,
+                 rate_per_minute: float = LLM_USER_RATE_PER_MINUTE,
+                 burst: float = LLM_USER_BURST,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_concurrency = max_concurrency
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.clock = clock
+        self._cv = threading.Condition()
+        self._heap = []
+        self._seq = itertools.count()
+        self._active = 0
+        self._buckets = {}   # user_id -> (tokens, last_refill)
+        self._last_prune = clock()
+        self._stats = {"admitted": 0, "queued": 0, "rate_limited": 0, "timed_out": 0}
+
+    # ----- token buckets -----
+    def _take_token(self, user_id):
+        now = self.clock()
+        tokens, last = self._buckets.get(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1.0:
+            self._buckets[user_id] = (tokens, now)
+            retry_after = (1.0 - tokens) / self.rate if self.rate else float("inf")
+            raise RateLimited(retry_after)
+        self._buckets[user_id] = (tokens - 1.0, now)
+        if self.rate and now - self._last_prune >= self.burst / self.rate:
+            self._prune_buckets(now)
+
+    def _prune_buckets(self, now):
+        # A bucket that has refilled to burst is the same as no bucket, so
+        # drop those instead of keeping one entry per user ever seen.
+        # Runs at most once per full-refill time.
+        self._last_prune = now
+        full = [user_id for user_id, (tokens, last) in self._buckets.items()
+                if tokens + (now - last) * self.rate >= self.burst]
+        for user_id in full:
+            del self._buckets[user_id]
+
+    # ----- queue -----
+    def _dispatch(self):
+        while self._heap and self._active < self.max_concurrency:
+            ticket = heapq.heappop(self._heap)
+            if ticket.cancelled:
+                continue
+            ticket.granted = True
+            self._active += 1
+        self._cv.notify_all()
+
+    def _position(self, ticket: _Ticket) -> int:
+        return 1 + sum(1 for t in self._heap if not t.cancelled and t < ticket)
+
+    def charge(self, user_id):
+        """Take one token from the user's bucket (raises RateLimited)."""
+        with self._cv:
+            try:
+                self._take_token(user_id)
+            except RateLimited:
+                self._stats["rate_limited"] += 1
+                raise
+
+    def acquire(self, user_id, premium: bool = False,
+                on_queued: Optional[Callable[[int], None]] = None,
+                timeout: float = LLM_QUEUE_TIMEOUT_SECONDS, charge: bool = True):
+        """Wait for an LLM slot. ``on_queued(position)`` is called (in this
+        thread) whenever the caller's 1-based queue position changes.
+        With ``charge=False`` the user's token bucket is not touched."""
+        if charge:
+            self.charge(user_id)
+        with self._cv:
+            ticket = _Ticket(PRIORITY_PREMIUM if premium else PRIORITY_FREE,
+                             next(self._seq), user_id)
+            heapq.heappush(self._heap, ticket)
+            self._dispatch()
+            if ticket.granted:
+                self._stats["admitted"] += 1
+                return ticket
+            self._stats["queued"] += 1
+            position = self._position(ticket)
+
+        deadline = self.clock() + timeout
+        last_reported = None
+        while True:
+            if on_queued and position != last_reported:
+                last_reported = position
+                try:
+                    on_queued(position)
+                except Exception:
+                    pass
+            with self._cv:
+                if not ticket.granted:
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        ticket.cancelled = True
+                        self._stats["timed_out"] += 1
+                        raise QueueTimeout()
+                    self._cv.wait(min(remaining, 1.0))
+                if ticket.granted:
+                    self._stats["admitted"] += 1
+                    return ticket
+                position = self._position(ticket)
+
+    def try_acquire(self, user_id, premium: bool = False) -> Optional[_Ticket]:
+        """A slot right now, or None if that would mean queueing (or
+        jumping the queue). Never charges the token bucket."""
+        with self._cv:
+            if self._active >= self.max_concurrency or any(not t.cancelled for t in self._heap):
+                return None
+            ticket = _Ticket(PRIORITY_PREMIUM if premium else PRIORITY_FREE,
+                             next(self._seq), user_id)
+            ticket.granted = True
+            self._active += 1
+            self._stats["admitted"] += 1
+            return ticket
+
+    def release(self, ticket: _Ticket):
+        with self._cv:
+            if ticket.granted:
+                ticket.granted = False
+                self._active -= 1
+                self._dispatch()
+
+    @contextmanager
+    def slot(self, user_id, premium: bool = False,
+             on_queued: Optional[Callable[[int], None]] = None,
+             timeout: float = LLM_QUEUE_TIMEOUT_SECONDS, charge: bool = True):
+        ticket = self.acquire(user_id, premium, on_queued, timeout, charge)
+        try:
+            yield
+        finally:
+            self.release(ticket)
+
+    def stats(self) -> dict:
+        with self._cv:
+            stats = dict(self._stats)
+            stats["active"] = self._active
+            stats["waiting"] = sum(1 for t in self._heap if not t.cancelled)
+        return stats
+
+
+# Process-wide scheduler used by bot.py / ai_engine.py
+scheduler = AdmissionScheduler()
+
+# ctx = (user_id, premium, on_queued) of the request this thread serves;
+# llm_metrics.propagate carries it to worker threads
+admission_local = threading.local()
+
+
+@contextmanager
+def admission(user_id, premium: bool = False,
+              on_queued: Optional[Callable[[int], None]] = None):
+    """Admit one user request: the user's bucket is charged once, here.
+    Upstream calls made inside (on this thread) take a slot with the
+    user's priority for as long as they run (upstream_slot)."""
+    scheduler.charge(user_id)
+    previous = getattr(admission_local, "ctx", None)
+    admission_local.ctx = (user_id, premium, on_queued)
+    try:
+        yield
+    finally:
+        admission_local.ctx = previous
+
+
+def try_extra_slot() -> Optional[_Ticket]:
+    """An additional slot for the current admission (e.g. a hedged
+    request) if one is free without queueing, else None. Give it back
+    with ``scheduler.release(ticket)``."""
+    user_id, premium, _ = getattr(admission_local, "ctx", None) or (None, False, None)
+    return scheduler.try_acquire(user_id, premium)
+
+
+@contextmanager
+def upstream_slot():
+    """Concurrency slot for one upstream LLM call, queued with the
+    priority of the current admission (unattributed calls queue as free)."""
+    user_id, premium, on_queued = getattr(admission_local, "ctx", None) or (None, False, None)
+    with scheduler.slot(user_id, premium, on_queued, charge=False):
+        yield
+
+
+# ==========================================================
+# OFFLINE SIMULATION
+# ==========================================================
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+def simulate(seed: int = 7, concurrency: int = 4, service_ms=(40, 160), time_scale: float = 1.0):
+    """Synthetic burst: one spamming free user, many normal free users and
+    a few premium users all arrive within ~1s. Prints per-class wait
+    percentiles, rate-limit outcomes and Jain's fairness index over the
+    requests served per (non-spamming) free user."""
+    rng = random.Random(seed)
+    # rate is scaled so the whole simulation runs in a few seconds
+    sched = AdmissionScheduler(max_concurrency=concurrency,
+                               rate_per_minute=LLM_USER_RATE_PER_MINUTE * 60 * time_scale,
+                               burst=LLM_USER_BURST)
+    arrivals = []
+    for i in range(40):
+        arrivals.append((rng.uniform(0, 0.3), "spammer", False))
+    for u in range(30):
+        for _ in range(2):
+            arrivals.append((rng.uniform(0, 1.0), f"free{u}", False))
+    for u in range(6):
+        for _ in range(2):
+            arrivals.append((rng.uniform(0, 1.0), f"pro{u}", True))
+    arrivals.sort()
+
+    waits = {"premium": [], "free": [], "spammer": []}
+    served = {}
+    limited = {}
+    lock = threading.Lock()
+    start = time.monotonic()
+
+    def client(at, user, premium):
+        time.sleep(max(0.0, at - (time.monotonic() - start)))
+        asked = time.monotonic()
+        try:
+            with sched.slot(user, premium, timeout=60):
+                waited = time.monotonic() - asked
+                time.sleep(rng.uniform(*service_ms) / 1000.0)
+        except RateLimited:
+            with lock:
+                limited[user] = limited.get(user, 0) + 1
+            return
+        cls = "spammer" if user == "spammer" else ("premium" if premium else "free")
+        with lock:
+            waits[cls].append(waited * 1000)
+            served[user] = served.get(user, 0) + 1
+
+    threads = [threading.Thread(target=client, args=a) for a in arrivals]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    print(f"{len(arrivals)} requests, concurrency {concurrency}, "
+          f"service {service_ms[0]}-{service_ms[1]} ms")
+    for cls, values in waits.items():
+        print(f"  {cls:8s} served {len(values):3d}  wait p50 {_percentile(values, 0.5):7.1f} ms"
+              f"  p95 {_percentile(values, 0.95):7.1f} ms")
+    print(f"  spammer rate-limited {limited.get('spammer', 0)} of 40")
+    counts = [served.get(f"free{u}", 0) for u in range(30)]
+    jain = (sum(counts) ** 2) / (len(counts) * sum(c * c for c in counts)) if any(counts) else 0
+    print(f"  fairness (Jain) across normal free users: {jain:.3f}")
+    return waits, served, limited
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LLM admission scheduler")
+    parser.add_argument("--simulate", action="store_true")
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+    if args.simulate:
+        simulate(concurrency=args.concurrency)
+    else:
+        parser.print_help()
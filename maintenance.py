@@ -0,0 +1,107 @@
+import logging
+import time
+
+from apscheduler.schedulers.background import BackgroundScheduler
+
+from config import (
+    MAINTENANCE_HOUR_UTC,
+    MAINTENANCE_LIGHT_INTERVAL_MINUTES,
+    LLM_USAGE_FLUSH_MINUTES,
+)
+from database import (
+    db_size_bytes,
+    fts_merge,
+    fts_optimize,
+    pragma_optimize,
+    wal_checkpoint,
+    incremental_vacuum,
+)
+import answer_cache
+import llm_metrics
+
+logger = logging.getLogger(__name__)
+
+_scheduler = None
+
+
+def _run(name: str, steps):
+    """Run maintenance steps in order, logging duration and DB size change."""
+    size_before = db_size_bytes()
+    started = time.perf_counter()
+    for step_name, step in steps:
+        step_started = time.perf_counter()
+        try:
+            step()
+        except Exception:
+            logger.exception("Maintenance step %s failed", step_name)
+            continue
+        logger.info("Maintenance %s: %s took %.2fs", name, step_name,
+                    time.perf_counter() - step_started)
+    size_after = db_size_bytes()
+    logger.info(
+        "Maintenance %s finished in %.2fs, DB size %d -> %d bytes (%+d)",
+        name, time.perf_counter() - started, size_before, size_after,
+        size_after - size_before,
+    )
+
+
+def run_light_maintenance():
+    """Hourly: merge a few FTS segments and checkpoint the WAL."""
+    _run("light", [
+        ("fts merge", fts_merge),
+        ("wal checkpoint", lambda: wal_checkpoint("PASSIVE")),
+    ])
+
+
+def run_full_maintenance():
+    """Nightly: expire cached answers, full FTS optimize, planner stats,
+    truncate WAL, vacuum."""
+    _run("full", [
+        ("purge expired answers", answer_cache.purge_expired),
+        ("fts optimize", fts_optimize),
+        ("pragma optimize", pragma_optimize),
+        ("wal checkpoint", lambda: wal_checkpoint("TRUNCATE")),
+        ("incremental vacuum", incremental_vacuum),
+    ])
+
+
+def flush_llm_usage():
+    try:
+        written = llm_metrics.flush_rollup()
+    except Exception:
+        logger.exception("LLM usage flush failed")
+        return
+    if written:
+        logger.debug("Flushed %d LLM usage rows", written)
+
+
+def start_maintenance_scheduler():
+    global _scheduler
+    if _scheduler:
+        return _scheduler
+
+    _scheduler = BackgroundScheduler(timezone="UTC")
+    _scheduler.add_job(
+        run_light_maintenance, "interval",
+        minutes=MAINTENANCE_LIGHT_INTERVAL_MINUTES,
+        id="db_light_maintenance", coalesce=True, max_instances=1,
+    )
+    _scheduler.add_job(
+        run_full_maintenance, "cron",
+        hour=MAINTENANCE_HOUR_UTC, minute=0,
+        id="db_full_maintenance", coalesce=True, max_instances=1,
+    )
+    _scheduler.add_job(
+        flush_llm_usage, "interval",
+        minutes=LLM_USAGE_FLUSH_MINUTES,
+        id="llm_usage_flush", coalesce=True, max_instances=1,
+    )
+    _scheduler.start()
+    return _scheduler
+
+
+def stop_maintenance_scheduler():
+    global _scheduler
+    if _scheduler:
+        _scheduler.shutdown(wait=False)
+        _scheduler = None
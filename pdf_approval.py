@@ -1,9 +1,55 @@
 
+import hashlib
+import logging
 import os
-from typing import Tuple
-from config import PENDING_PDFS_FOLDER, BOOKS_FOLDER
-from database import insert_document, update_document_status, add_document_chunk, get_document
-from pdf_ingest import read_pdf_text, chunk_text
+import threading
+from typing import Callable, Optional, Tuple
+from config import PENDING_PDFS_FOLDER, BOOKS_FOLDER, INGEST_BATCH_CHUNKS
+from database import (
+    insert_document,
+    update_document_status,
+    get_document,
+    set_document_pages,
+    trim_partial_chunks,
+    find_document_by_hash,
+    set_document_hash,
+    list_unhashed_documents,
+    mark_document_duplicate,
+    replace_document_chunks,
+    list_pending_documents,
+)
+from pdf_ingest import ingest_pages, pdf_page_count, sha256_file, HASH_BLOCK_SIZE, _update_vector_index
+import extract_cache
+
+logger = logging.getLogger(__name__)
+
+_register_lock = threading.Lock()
+
+class HashingWriter:
+    """Binary sink for ``File.download(out=...)``: writes to ``path`` and
+    computes the SHA-256 of the content in the same pass."""
+
+    def __init__(self, path: str):
+        self._file = open(path, "wb")
+        self._sha = hashlib.sha256()
+
+    def write(self, data) -> int:
+        view = memoryview(data)
+        for offset in range(0, len(view), HASH_BLOCK_SIZE):
+            self._sha.update(view[offset:offset + HASH_BLOCK_SIZE])
+        return self._file.write(data)
+
+    def hexdigest(self) -> str:
+        return self._sha.hexdigest()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 def save_pending_pdf(file_path: str, original_filename: str) -> str:
     os.makedirs(PENDING_PDFS_FOLDER, exist_ok=True)
@@ -15,26 +61,160 @@ def save_pending_pdf(file_path: str, original_filename: str) -> str:
     os.replace(file_path, dest_path)
     return dest_path
 
-def approve_pending_pdf(doc_id: int, admin_user_id: int) -> Tuple[bool, str]:
+def register_upload(tmp_path: str, original_filename: str, content_sha256: str,
+                    uploaded_by_user_id: int):
+    """Store an uploaded PDF as a pending document, unless the same content
+    is already approved or pending: then the upload is recorded as a
+    duplicate linked to that document and the file is discarded.
+
+    Returns ``(doc_id, original)``; ``original`` is None for new content.
+    """
+    with _register_lock:
+        original = find_document_by_hash(content_sha256)
+        if original is not None:
+            os.remove(tmp_path)
+            doc_id = insert_document(
+                title=original_filename,
+                filename=original["filename"],
+                pages=original["pages"] or 0,
+                uploaded_by_user_id=uploaded_by_user_id,
+                status="duplicate",
+                content_sha256=content_sha256,
+                duplicate_of=original["id"],
+            )
+            return doc_id, original
+
+        final_path = save_pending_pdf(tmp_path, original_filename)
+        doc_id = insert_document(
+            title=original_filename,
+            filename=os.path.basename(final_path),
+            pages=0,
+            uploaded_by_user_id=uploaded_by_user_id,
+            status="pending",
+            content_sha256=content_sha256,
+        )
+    extract_cache.prefetch(doc_id, content_sha256, final_path)
+    return doc_id, None
+
+def backfill_document_hashes() -> int:
+    """Hash approved / pending documents stored before hashes existed."""
+    hashed = 0
+    for doc in list_unhashed_documents():
+        for path in _pdf_paths(doc):
+            if os.path.exists(path):
+                set_document_hash(doc["id"], sha256_file(path))
+                hashed += 1
+                break
+    return hashed
+
+def _pdf_paths(doc) -> Tuple[str, str]:
+    return (os.path.join(PENDING_PDFS_FOLDER, doc["filename"]),
+            os.path.join(BOOKS_FOLDER, doc["filename"]))
+
+def check_pending_pdf(doc_id: int) -> Tuple[bool, str]:
+    """Whether a document can be approved, with the reason if not."""
     doc = get_document(doc_id)
     if not doc:
         return False, "Document not found."
+    if doc["status"] == "approved":
+        return False, f"Document {doc_id} is already approved."
+    if doc["status"] == "duplicate":
+        return False, f"Document {doc_id} is a duplicate of document {doc['duplicate_of']}."
 
-    pending_path = os.path.join(PENDING_PDFS_FOLDER, doc["filename"])
-    if not os.path.exists(pending_path):
+    pending_path, approved_path = _pdf_paths(doc)
+    # An interrupted approval has already moved the file to BOOKS_FOLDER
+    if not os.path.exists(pending_path) and not os.path.exists(approved_path):
         return False, "Pending PDF file not found on server."
+    return True, ""
+
+def _insert_prepared_chunks(doc_id: int, content_sha256: str, pages_total: int,
+                            progress: Optional[Callable[[int, int, int], None]]):
+    """Bulk-insert the pre-extracted chunks of a document, replacing any
+    left by an interrupted run, in one transaction. Progress is reported
+    once the swap is committed (a progress write inside it would commit
+    it early). Returns ``(old_chunk_ids, written)``."""
+    set_document_pages(doc_id, pages_total)
+    old_ids, written = replace_document_chunks(doc_id, extract_cache.iter_rows(content_sha256),
+                                               batch_size=INGEST_BATCH_CHUNKS)
+    if progress is not None:
+        progress(pages_total, pages_total, written)
+    return old_ids, written
+
+def prefetch_pending() -> int:
+    """Queue pre-extraction for pending uploads that have no sidecar yet."""
+    queued = 0
+    for doc in list_pending_documents():
+        pending_path, _ = _pdf_paths(doc)
+        if doc["content_sha256"] and os.path.exists(pending_path):
+            if extract_cache.prefetch(doc["id"], doc["content_sha256"], pending_path):
+                queued += 1
+    return queued
+
+def approve_pending_pdf(doc_id: int, admin_user_id: int,
+                        progress: Optional[Callable[[int, int, int], None]] = None) -> Tuple[bool, str]:
+    """Move a pending PDF into BOOKS_FOLDER, ingest and index it.
+
+    If the upload was pre-extracted (extract_cache) its chunks are just
+    bulk-inserted; otherwise the PDF is parsed now. Safe to call again
+    after an interruption: parsing resumes after the last fully committed
+    page. ``progress(pages_done, pages_total, chunks_done)`` is called
+    after every committed chunk batch.
+    """
+    ok, msg = check_pending_pdf(doc_id)
+    if not ok:
+        return False, msg
+
+    doc = get_document(doc_id)
+    pending_path, approved_path = _pdf_paths(doc)
+
+    content_sha256 = doc["content_sha256"]
+    if content_sha256 is None:
+        content_sha256 = sha256_file(pending_path if os.path.exists(pending_path) else approved_path)
+        set_document_hash(doc["id"], content_sha256)
+    original = find_document_by_hash(content_sha256, exclude_id=doc["id"])
+    if original is not None and original["status"] == "approved":
+        # Same content already indexed (e.g. uploaded before hashing existed)
+        mark_document_duplicate(doc["id"], original["id"])
+        if os.path.exists(pending_path):
+            os.remove(pending_path)
+        return True, (f"Document {doc_id} is identical to approved document "
+                      f"{original['id']}; linked to it instead of indexing it again.")
+
+    # A background pre-extraction may still be reading the pending file
+    extract_cache.wait_for_prefetch(content_sha256)
+    if os.path.exists(pending_path):
+        os.makedirs(BOOKS_FOLDER, exist_ok=True)
+        os.replace(pending_path, approved_path)
+
+    header = extract_cache.load_header(content_sha256)
+    if header is not None:
+        try:
+            old_ids, written = _insert_prepared_chunks(doc["id"], content_sha256,
+                                                       header["pages"], progress)
+        except ValueError:
+            logger.exception("Sidecar for document %s unusable, parsing the PDF", doc["id"])
+            os.remove(extract_cache.sidecar_path(content_sha256))
+        else:
+            _update_vector_index(doc["id"], replaced_chunk_ids=old_ids)
+            update_document_status(doc["id"], "approved", admin_user_id)
+            return True, f"Document {doc_id} approved with {written} chunks."
+
+    pages_total = pdf_page_count(approved_path)
+    set_document_pages(doc["id"], pages_total)
 
-    os.makedirs(BOOKS_FOLDER, exist_ok=True)
-    approved_path = os.path.join(BOOKS_FOLDER, doc["filename"])
-    os.replace(pending_path, approved_path)
+    first_page, first_index, kept = trim_partial_chunks(doc["id"])
+    if kept:
+        logger.info("Resuming ingestion of document %s at page %d (%d chunks kept)",
+                    doc["id"], first_page, kept)
 
-    pages_text = read_pdf_text(approved_path)
-    combined = "\n".join(pages_text)
-    chunks = chunk_text(combined)
+    on_progress = None
+    if progress is not None:
+        def on_progress(pages_done, chunks_done):
+            progress(pages_done, pages_total, chunks_done)
 
-    for idx, chunk in enumerate(chunks):
-        token_count = len(chunk.split())
-        add_document_chunk(doc["id"], idx, chunk, token_count)
+    written = ingest_pages(doc["id"], approved_path, first_page=first_page,
+                           first_index=first_index, progress=on_progress)
+    _update_vector_index(doc["id"])
 
     update_document_status(doc["id"], "approved", admin_user_id)
-    return True, f"Document {doc_id} approved with {len(chunks)} chunks."
+    return True, f"Document {doc_id} approved with {first_index + written} chunks."
@@ -1,60 +1,245 @@
 
+import argparse
+import hashlib
+import logging
+import multiprocessing
 import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from math import ceil
-from typing import List
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
 from pypdf import PdfReader
-from database import insert_document, add_document_chunk
+from config import (
+    BOOKS_FOLDER,
+    PDF_EXTRACT_WORKERS,
+    PDF_PARALLEL_MIN_PAGES,
+    INGEST_BATCH_CHUNKS,
+)
+from database import insert_document, add_document_chunks, find_document_by_hash
+from context_packer import count_tokens
+from vector_index import index_document, drop_chunks
 
-def read_pdf_text(file_path: str) -> List[str]:
+logger = logging.getLogger(__name__)
+
+HASH_BLOCK_SIZE = 1024 * 1024
+PAGE_RANGE_MAX_PAGES = 32        # pages per parallel extraction task
+CHUNK_MAX_CHARS = 1200
+
+def _page_text(page) -> str:
+    try:
+        return page.extract_text() or ""
+    except Exception:
+        return ""
+
+def _extract_page_range(file_path: str, start: int, stop: int) -> List[str]:
+    # Runs in a worker process; each worker opens its own reader
     reader = PdfReader(file_path)
-    pages_text = []
-    for page in reader.pages:
-        try:
-            text = page.extract_text() or ""
-        except Exception:
-            text = ""
-        pages_text.append(text)
-    return pages_text
-
-def chunk_text(text: str, max_chars: int = 1200) -> List[str]:
-    # Simple character-based chunking
-    chunks = []
-    text = text.replace("\r", "").replace("\n\n", "\n")
+    return [_page_text(reader.pages[i]) for i in range(start, stop)]
+
+def _extract_workers(workers: Optional[int]) -> int:
+    if workers is None:
+        workers = PDF_EXTRACT_WORKERS
+    return workers if workers > 0 else (os.cpu_count() or 1)
+
+def sha256_file(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def pdf_page_count(file_path: str) -> int:
+    return len(PdfReader(file_path).pages)
+
+def iter_pdf_pages(file_path: str, workers: Optional[int] = None,
+                   first_page: int = 1) -> Iterator[Tuple[int, str]]:
+    """Yield ``(page_number, text)`` (1-based, in order, from ``first_page``;
+    "" for pages that fail to extract) without holding the whole
+    document's text.
+
+    PDFs with at least PDF_PARALLEL_MIN_PAGES pages are split into page
+    ranges and extracted in a process pool of ``workers`` processes
+    (PDF_EXTRACT_WORKERS by default)."""
+    reader = PdfReader(file_path)
+    page_count = len(reader.pages)
+    workers = _extract_workers(workers)
+    if workers <= 1 or page_count - first_page + 1 < PDF_PARALLEL_MIN_PAGES:
+        for index in range(first_page - 1, page_count):
+            yield index + 1, _page_text(reader.pages[index])
+        return
+    del reader
+    yield from _iter_pdf_pages_parallel(file_path, page_count, workers, first_page)
+
+def _iter_pdf_pages_parallel(file_path: str, page_count: int, workers: int,
+                             first_page: int = 1) -> Iterator[Tuple[int, str]]:
+    # A few ranges per worker so one slow (image-heavy) range doesn't idle the
+    # rest, but never more than PAGE_RANGE_MAX_PAGES so the text in flight
+    # (window * step pages) stays bounded however long the PDF is
+    step = max(1, min(PAGE_RANGE_MAX_PAGES, ceil((page_count - first_page + 1) / (workers * 4))))
+    ranges = deque((start, min(start + step, page_count))
+                   for start in range(first_page - 1, page_count, step))
+    # Only this many ranges are extracted ahead of the consumer
+    window = workers * 2
+    in_flight = deque()
+    # spawn, not fork: the bot process has live threads and DB connections
+    with ProcessPoolExecutor(max_workers=min(workers, len(ranges)),
+                             mp_context=multiprocessing.get_context("spawn")) as pool:
+        while ranges or in_flight:
+            while ranges and len(in_flight) < window:
+                start, stop = ranges.popleft()
+                in_flight.append((start, stop, pool.submit(_extract_page_range, file_path, start, stop)))
+            start, stop, future = in_flight.popleft()
+            try:
+                texts = future.result()
+            except Exception:
+                # Worker died on this range; redo it here page by page
+                logger.exception("Parallel extraction of pages %d-%d failed, retrying serially",
+                                 start + 1, stop)
+                texts = _extract_page_range(file_path, start, stop)
+            yield from enumerate(texts, start=start + 1)
+
+def read_pdf_text(file_path: str, workers: Optional[int] = None) -> List[str]:
+    """Text of every page, in page order (see iter_pdf_pages)."""
+    return [text for _, text in iter_pdf_pages(file_path, workers)]
+
+def iter_chunks(pages: Iterable[Tuple[int, str]],
+                max_chars: int = CHUNK_MAX_CHARS) -> Iterator[Tuple[str, int, int]]:
+    """Incremental character-based chunker over ``(page_number, text)``.
+
+    Yields ``(content, page_start, page_end)``; only the chunk being built
+    is held in memory. Page breaks count as line breaks."""
     current = []
     current_len = 0
-    for line in text.split("\n"):
-        if current_len + len(line) + 1 > max_chars:
-            if current:
-                chunks.append("\n".join(current))
-            current = [line]
-            current_len = len(line)
-        else:
-            current.append(line)
-            current_len += len(line) + 1
+    first_page = last_page = None
+    for number, text in pages:
+        text = text.replace("\r", "").replace("\n\n", "\n")
+        for line in text.split("\n"):
+            if current_len + len(line) + 1 > max_chars:
+                if current:
+                    yield "\n".join(current), first_page, last_page
+                current = [line]
+                current_len = len(line)
+                first_page = number
+            else:
+                current.append(line)
+                current_len += len(line) + 1
+                if first_page is None:
+                    first_page = number
+            last_page = number
     if current:
-        chunks.append("\n".join(current))
-    return chunks
+        yield "\n".join(current), first_page, last_page
+
+def chunk_text(text: str, max_chars: int = CHUNK_MAX_CHARS) -> List[str]:
+    # Simple character-based chunking
+    return [content for content, _, _ in iter_chunks([(1, text)], max_chars)]
+
+def chunk_rows(chunks: Iterable, start: int = 0):
+    """Yield rows for add_document_chunks from chunk strings or from
+    ``(content, page_start, page_end)`` tuples (iter_chunks)."""
+    for idx, chunk in enumerate(chunks, start=start):
+        if isinstance(chunk, str):
+            yield idx, chunk, count_tokens(chunk)
+        else:
+            content, page_start, page_end = chunk
+            yield idx, content, count_tokens(content), page_start, page_end
+
+def ingest_pages(doc_id: int, file_path: str, workers: Optional[int] = None,
+                 first_page: int = 1, first_index: int = 0,
+                 progress: Optional[Callable[[int, int], None]] = None) -> int:
+    """Stream a PDF into document_chunks: page generator -> incremental
+    chunker -> batched writer. Memory stays around one write batch
+    whatever the PDF size. Returns the number of chunks written.
+
+    ``first_page`` / ``first_index`` resume an interrupted run (see
+    database.trim_partial_chunks). ``progress(pages_read, chunks_written)``
+    is called after every committed batch."""
+    pages_read = first_page - 1
+
+    def counted_pages():
+        nonlocal pages_read
+        for number, text in iter_pdf_pages(file_path, workers, first_page):
+            yield number, text
+            pages_read = number
+
+    on_commit = None
+    if progress is not None:
+        def on_commit(written):
+            progress(pages_read, first_index + written)
+
+    chunks = iter_chunks(counted_pages())
+    return add_document_chunks(doc_id, chunk_rows(chunks, start=first_index),
+                               batch_size=INGEST_BATCH_CHUNKS, on_commit=on_commit)
+
+def _update_vector_index(doc_id: int, replaced_chunk_ids=()):
+    # FTS is the source of truth; a vector index failure must not fail ingestion
+    try:
+        if replaced_chunk_ids:
+            drop_chunks(replaced_chunk_ids)
+        index_document(doc_id)
+    except Exception:
+        logger.exception("Failed to add document %s to the vector index", doc_id)
 
 def ingest_pdf(title: str, src_path: str, dest_folder: str, uploaded_by_user_id: int):
+    """Ingest a PDF straight into the library. If identical content is
+    already approved, nothing is stored and ``(existing_id, 0)`` is returned."""
+    content_sha256 = sha256_file(src_path)
+    existing = find_document_by_hash(content_sha256)
+    if existing is not None and existing["status"] == "approved":
+        logger.info("%s is identical to document %s, skipping", src_path, existing["id"])
+        return existing["id"], 0
+
     os.makedirs(dest_folder, exist_ok=True)
     filename = os.path.basename(src_path)
     dest_path = os.path.join(dest_folder, filename)
     if src_path != dest_path:
         os.replace(src_path, dest_path)
 
-    pages_text = read_pdf_text(dest_path)
     doc_id = insert_document(
         title=title,
         filename=filename,
-        pages=len(pages_text),
+        pages=pdf_page_count(dest_path),
         uploaded_by_user_id=uploaded_by_user_id,
         status="approved",
+        content_sha256=content_sha256,
     )
 
-    combined_text = "\n".join(pages_text)
-    chunks = chunk_text(combined_text)
-    for idx, chunk in enumerate(chunks):
-        token_count = len(chunk.split())
-        add_document_chunk(doc_id, idx, chunk, token_count)
+    chunk_count = ingest_pages(doc_id, dest_path)
+    _update_vector_index(doc_id)
+
+    return doc_id, chunk_count
+
+def benchmark(paths: List[str], workers: Optional[int] = None):
+    """Serial vs parallel extraction throughput (pages/sec) per PDF."""
+    workers = _extract_workers(workers)
+    for path in paths:
+        started = time.perf_counter()
+        serial = read_pdf_text(path, workers=1)
+        serial_s = time.perf_counter() - started
+
+        started = time.perf_counter()
+        parallel = [text for _, text in _iter_pdf_pages_parallel(path, len(serial), max(2, workers))]
+        parallel_s = time.perf_counter() - started
+
+        pages = len(serial)
+        print(f"{os.path.basename(path)}: {pages} pages")
+        print(f"  serial              {serial_s:7.2f}s  {pages / serial_s:7.1f} pages/s")
+        print(f"  parallel ({max(2, workers)} procs)  {parallel_s:7.2f}s  {pages / parallel_s:7.1f} pages/s"
+              f"  ({serial_s / parallel_s:.2f}x, identical: {serial == parallel})")
 
-    return doc_id, len(chunks)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PDF text extraction")
+    parser.add_argument("--bench", action="store_true",
+                        help="compare serial and parallel extraction")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("pdfs", nargs="*",
+                        help=f"PDF files (default: every PDF in {BOOKS_FOLDER}/)")
+    args = parser.parse_args()
+    if args.bench:
+        paths = args.pdfs or sorted(
+            os.path.join(BOOKS_FOLDER, name) for name in os.listdir(BOOKS_FOLDER)
+            if name.lower().endswith(".pdf")
+        )
+        benchmark(paths, args.workers)
+    else:
+        parser.print_help()
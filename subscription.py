@@ -1,5 +1,5 @@
 from typing import Tuple
-from database import get_or_create_user, update_user_messages
+from database import get_or_create_user, update_user_messages, reserve_user_message
 from config import FREE_MESSAGES, PREMIUM_PRICE_INR, PAYMENT_INSTRUCTIONS
 
 
@@ -8,38 +8,42 @@ def ensure_user(chat_id: int, username: str, full_name: str):
     return get_or_create_user(chat_id, username, full_name)
 
 
-def can_user_ask(user_row) -> Tuple[bool, str]:
+def _quota_exhausted_text() -> str:
+    return (
+        "🚫 *Your free message limit is over.*\n\n"
+        f"Upgrade to *Lifetime Pro* for just ₹{PREMIUM_PRICE_INR}.\n\n"
+        f"{PAYMENT_INSTRUCTIONS}\n"
+        "After the payment, upload your payment screenshot here.\n"
+        "Admin will verify & activate your lifetime access. 🔓"
+    )
+
+
+def reserve_message(user_row) -> Tuple[bool, str]:
     """
+    Gate a request by atomically reserving one message from the quota.
+    This is the only check callers should use before answering; call
+    refund_message() if the answer could not be produced.
+
     Returns:
         (allowed: bool, message: str)
     """
-    # Premium users = unlimited
+    # Premium users = unlimited, no write needed
     if user_row["is_premium"]:
         return True, ""
 
-    # Free messages remain
-    if user_row["free_messages"] > 0:
+    if reserve_user_message(user_row["id"]) is not None:
         return True, ""
 
     # No free messages left → send manual payment instructions
-    msg = (
-        "🚫 *Your free message limit is over.*\n\n"
-        f"Upgrade to *Lifetime Pro* for just ₹{PREMIUM_PRICE_INR}.\n\n"
-        f"{PAYMENT_INSTRUCTIONS}\n"
-        "After the payment, upload your payment screenshot here.\n"
-        "Admin will verify & activate your lifetime access. 🔓"
-    )
-
-    return False, msg
+    return False, _quota_exhausted_text()
 
 
-def consume_message(user_row):
-    """Reduces free message count unless premium."""
+def refund_message(user_row):
+    """Give back a message reserved by reserve_message()."""
     if user_row["is_premium"]:
         return
 
-    if user_row["free_messages"] > 0:
-        update_user_messages(user_row["id"], -1)
+    update_user_messages(user_row["id"], 1)
 
 
 def subscription_status_text(user_row) -> str:
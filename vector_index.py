@@ -0,0 +1,518 @@
+"""
+Offline dense-vector index over document_chunks for hybrid retrieval.
+
+- Embedder is pluggable (set_embedder); the default is TF-IDF + truncated
+  SVD (LSA) fitted on our own chunks, so no network or model download.
+- Vectors are L2-normalised float32 rows in a memory-mapped file, with a
+  parallel file of chunk ids; new chunks are appended incrementally.
+- If there is no index on disk it is built on a background thread;
+  retrieval is BM25-only until it is ready.
+- hybrid_search() fuses FTS5/BM25 and vector rankings with reciprocal
+  rank fusion.
+
+Benchmark:  python vector_index.py --bench [--sizes 10000,100000,1000000]
+"""
+
+import argparse
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import Counter
+from math import log
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from config import (
+    VECTOR_INDEX_ENABLED,
+    VECTOR_INDEX_DIR,
+    VECTOR_DIM,
+    VECTOR_CANDIDATES,
+    HYBRID_RRF_K,
+)
+from database import (
+    search_chunks,
+    get_chunks_by_ids,
+    iter_chunk_texts,
+    sample_chunk_texts,
+    close_connection,
+)
+
+logger = logging.getLogger(__name__)
+
+_TOKEN_RE = re.compile(r"\w{2,}", re.UNICODE)
+
+# Rows scored per matmul block, keeps peak memory flat for big indexes
+SEARCH_BLOCK_ROWS = 65536
+EMBED_BATCH = 512
+# After a build that failed or found no chunks, searches wait this long
+# before starting another one (ingesting a document builds right away)
+BUILD_RETRY_SECONDS = 300
+
+
+def _tokenize(text: str) -> List[str]:
+    return _TOKEN_RE.findall((text or "").lower())
+
+
+# ==========================================================
+# EMBEDDERS
+# ==========================================================
+class Embedder:
+    """Interface for pluggable embedders."""
+
+    name = "base"
+    dim = 0
+    fit_sample = 0   # chunks sampled from the DB for fit()
+
+    @property
+    def is_fitted(self) -> bool:
+        return True
+
+    def fit(self, texts: List[str]):
+        """Learn from a corpus sample. No-op for pretrained embedders."""
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Return an (n, dim) float32 array of L2-normalised vectors."""
+        raise NotImplementedError
+
+    def save(self, path: str):
+        pass
+
+    def load(self, path: str) -> bool:
+        return True
+
+
+class TfidfSvdEmbedder(Embedder):
+    """TF-IDF (sublinear tf) projected onto a truncated SVD basis (LSA)."""
+
+    name = "tfidf-svd"
+
+    def __init__(self, dim: int = VECTOR_DIM, max_features: int = 8192,
+                 min_df: int = 2, fit_sample: int = 5000, seed: int = 13):
+        self.target_dim = dim
+        self.dim = dim
+        self.max_features = max_features
+        self.min_df = min_df
+        self.fit_sample = fit_sample
+        self.seed = seed
+        self.vocab = {}
+        self.idf = None
+        self.components = None   # (vocab, dim)
+
+    @property
+    def is_fitted(self) -> bool:
+        return self.components is not None
+
+    def _tfidf(self, text: str) -> Tuple[np.ndarray, np.ndarray]:
+        counts = Counter(t for t in _tokenize(text) if t in self.vocab)
+        if not counts:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        idx = np.fromiter((self.vocab[t] for t in counts), dtype=np.int64, count=len(counts))
+        tf = np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+        weights = (1.0 + np.log(tf)) * self.idf[idx]
+        weights /= np.linalg.norm(weights) or 1.0
+        return idx, weights
+
+    def fit(self, texts: List[str]):
+        rng = np.random.default_rng(self.seed)
+        if len(texts) > self.fit_sample:
+            pick = rng.choice(len(texts), self.fit_sample, replace=False)
+            texts = [texts[i] for i in pick]
+
+        df = Counter()
+        for text in texts:
+            df.update(set(_tokenize(text)))
+        min_df = self.min_df if len(texts) >= 10 * self.min_df else 1
+        terms = [t for t, c in df.most_common() if c >= min_df][: self.max_features]
+        if not terms:
+            raise ValueError("No vocabulary to fit the embedder on")
+        self.vocab = {t: i for i, t in enumerate(terms)}
+        n_docs = len(texts)
+        self.idf = np.array(
+            [log((1 + n_docs) / (1 + df[t])) + 1.0 for t in terms], dtype=np.float32
+        )
+
+        # X (n_docs x n_terms) is kept sparse, one (term ids, weights) row
+        # per text; a dense matrix would be n_docs * max_features floats
+        rows = [self._tfidf(text) for text in texts]
+        n_terms = len(terms)
+
+        def x_dot(b: np.ndarray) -> np.ndarray:
+            out = np.zeros((n_docs, b.shape[1]), dtype=np.float32)
+            for r, (idx, w) in enumerate(rows):
+                if idx.size:
+                    out[r] = w @ b[idx]
+            return out
+
+        def xt_dot(q: np.ndarray) -> np.ndarray:
+            out = np.zeros((n_terms, q.shape[1]), dtype=np.float32)
+            for r, (idx, w) in enumerate(rows):
+                if idx.size:
+                    out[idx] += np.outer(w, q[r])
+            return out
+
+        # Randomised truncated SVD (Halko et al.), 2 power iterations
+        k = max(1, min(self.target_dim, n_docs, n_terms))
+        p = min(10, min(n_docs, n_terms) - k)
+        omega = rng.standard_normal((n_terms, k + p), dtype=np.float32)
+        q, _ = np.linalg.qr(x_dot(omega))
+        for _ in range(2):
+            q, _ = np.linalg.qr(x_dot(xt_dot(q)))
+        _, _, vt = np.linalg.svd(xt_dot(q).T, full_matrices=False)
+        self.components = np.ascontiguousarray(vt[:k].T, dtype=np.float32)
+        self.dim = k
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            idx, w = self._tfidf(text)
+            if idx.size:
+                out[row] = w @ self.components[idx]
+        norms = np.linalg.norm(out, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return out / norms
+
+    def save(self, path: str):
+        terms = sorted(self.vocab, key=self.vocab.get)
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, terms=np.array(terms), idf=self.idf, components=self.components)
+        os.replace(tmp, path)
+
+    def load(self, path: str) -> bool:
+        if not os.path.exists(path):
+            return False
+        data = np.load(path, allow_pickle=False)
+        self.vocab = {t: i for i, t in enumerate(data["terms"].tolist())}
+        self.idf = data["idf"]
+        self.components = data["components"]
+        self.dim = self.components.shape[1]
+        return True
+
+
+# ==========================================================
+# VECTOR STORE
+# ==========================================================
+class VectorIndex:
+    """Append-only float32 matrix on disk plus the chunk id of every row."""
+
+    def __init__(self, folder: str, embedder: Embedder):
+        self.folder = folder
+        self.embedder = embedder
+        self.vectors_path = os.path.join(folder, "vectors.f32")
+        self.ids_path = os.path.join(folder, "ids.i64")
+        self.model_path = os.path.join(folder, f"{embedder.name}.npz")
+        self._lock = threading.RLock()
+        self._matrix = None
+        self._ids = None
+        self._rows = -1
+
+    # ----- persistence -----
+    def _row_count(self) -> int:
+        if not self.embedder.dim:
+            return 0
+        try:
+            n_vec = os.path.getsize(self.vectors_path) // (4 * self.embedder.dim)
+            n_ids = os.path.getsize(self.ids_path) // 8
+        except OSError:
+            return 0
+        return min(n_vec, n_ids)
+
+    def _view(self):
+        """Memory-map the current rows (re-mapped only when rows were added)."""
+        with self._lock:
+            rows = self._row_count()
+            if rows != self._rows:
+                if rows == 0:
+                    self._matrix = np.zeros((0, self.embedder.dim), dtype=np.float32)
+                    self._ids = np.zeros(0, dtype=np.int64)
+                else:
+                    self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode="r",
+                                             shape=(rows, self.embedder.dim))
+                    self._ids = np.memmap(self.ids_path, dtype=np.int64, mode="r", shape=(rows,))
+                self._rows = rows
+            return self._matrix, self._ids
+
+    def load(self) -> bool:
+        with self._lock:
+            ok = self.embedder.load(self.model_path)
+            self._rows = -1
+            return ok and self.embedder.is_fitted
+
+    def __len__(self):
+        return self._row_count()
+
+    # ----- writes -----
+    def append(self, chunk_ids: List[int], vectors: np.ndarray):
+        if not chunk_ids:
+            return
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self._lock:
+            os.makedirs(self.folder, exist_ok=True)
+            rows = self._row_count()
+            # Truncate a torn tail left by a crash before appending
+            for path, width in ((self.vectors_path, 4 * self.embedder.dim), (self.ids_path, 8)):
+                if os.path.exists(path) and os.path.getsize(path) != rows * width:
+                    with open(path, "r+b") as f:
+                        f.truncate(rows * width)
+            with open(self.vectors_path, "ab") as f:
+                f.write(vectors.tobytes())
+            with open(self.ids_path, "ab") as f:
+                f.write(np.asarray(chunk_ids, dtype=np.int64).tobytes())
+
+    def remove(self, chunk_ids: Iterable[int]) -> int:
+        """Tombstone the rows of ``chunk_ids`` (id set to -1, skipped by
+        search) until the next rebuild. Returns rows removed."""
+        chunk_ids = np.fromiter(chunk_ids, dtype=np.int64)
+        with self._lock:
+            rows = self._row_count()
+            if not rows or not chunk_ids.size:
+                return 0
+            ids = np.memmap(self.ids_path, dtype=np.int64, mode="r+", shape=(rows,))
+            hit = np.isin(ids, chunk_ids)
+            removed = int(hit.sum())
+            if removed:
+                ids[hit] = -1
+                ids.flush()
+            del ids
+            self._rows = -1
+            return removed
+
+    def _append_batch(self, batch: List[Tuple[int, str]], skip_existing: bool) -> int:
+        if skip_existing:
+            _, ids = self._view()
+            present = np.isin(np.fromiter((i for i, _ in batch), dtype=np.int64), ids)
+            batch = [item for item, p in zip(batch, present) if not p]
+        if batch:
+            self.append([i for i, _ in batch], self.embedder.embed([t for _, t in batch]))
+        return len(batch)
+
+    def add_texts(self, items: Iterable[Tuple[int, str]], skip_existing: bool = False) -> int:
+        """Embed and append (chunk_id, text) pairs in batches. With
+        ``skip_existing``, chunk ids already in the index are left out."""
+        added = 0
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= EMBED_BATCH:
+                added += self._append_batch(batch, skip_existing)
+                batch = []
+        if batch:
+            added += self._append_batch(batch, skip_existing)
+        return added
+
+    def rebuild(self, items_factory, fit_texts: List[str]) -> int:
+        """Refit the embedder on ``fit_texts`` (a corpus sample) and
+        re-embed everything.
+
+        ``items_factory`` returns a fresh iterable of (chunk_id, text).
+        """
+        with self._lock:
+            if fit_texts:
+                self.embedder.fit(fit_texts)
+            if not self.embedder.is_fitted:
+                return 0
+            os.makedirs(self.folder, exist_ok=True)
+            for path in (self.vectors_path, self.ids_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self._matrix = self._ids = None
+            self._rows = -1
+            added = self.add_texts(items_factory())
+            self.embedder.save(self.model_path)
+            return added
+
+    # ----- reads -----
+    def search(self, query_vector: np.ndarray, k: int) -> List[Tuple[int, float]]:
+        """Top-k (chunk_id, cosine score), best first."""
+        matrix, ids = self._view()
+        n = matrix.shape[0]
+        if n == 0 or k <= 0:
+            return []
+        q = np.asarray(query_vector, dtype=np.float32).reshape(-1)
+        scores = np.empty(n, dtype=np.float32)
+        for start in range(0, n, SEARCH_BLOCK_ROWS):
+            end = min(start + SEARCH_BLOCK_ROWS, n)
+            np.matmul(matrix[start:end], q, out=scores[start:end])
+            block = scores[start:end]
+            block[ids[start:end] < 0] = -np.inf   # removed rows
+        k = min(k, n)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[i]), float(scores[i])) for i in top if ids[i] >= 0]
+
+    def query(self, text: str, k: int) -> List[Tuple[int, float]]:
+        return self.search(self.embedder.embed([text])[0], k)
+
+
+# ==========================================================
+# MODULE-LEVEL INDEX (used by ai_engine / ingestion)
+# ==========================================================
+_index = None          # ready to query
+_embedder = None       # set_embedder() override of the default embedder
+_build_thread = None
+_retry_at = 0.0        # monotonic time before which searches don't rebuild
+_index_lock = threading.Lock()
+
+
+def set_embedder(embedder: Embedder):
+    """Swap in another embedder; the index is rebuilt on next use."""
+    global _index, _embedder
+    with _index_lock:
+        _embedder = embedder
+        _index = None
+
+
+def _build_index(index: VectorIndex):
+    global _index, _build_thread, _retry_at
+    started = time.perf_counter()
+    try:
+        added = index.rebuild(iter_chunk_texts, sample_chunk_texts(index.embedder.fit_sample))
+    except Exception:
+        logger.exception("Building the vector index failed")
+        added = 0
+    finally:
+        close_connection()
+    with _index_lock:
+        if added and (_embedder is None or _embedder is index.embedder):
+            _index = index
+        elif not added:
+            _retry_at = time.monotonic() + BUILD_RETRY_SECONDS
+        _build_thread = None
+    if added:
+        logger.info("Built vector index: %d chunks in %.1fs", added, time.perf_counter() - started)
+    else:
+        logger.info("No vector index built, retrying in %ds at the earliest", BUILD_RETRY_SECONDS)
+
+
+def start_index_build(force: bool = False) -> Optional[threading.Thread]:
+    """Load the index from disk, or start building it from document_chunks
+    on a background thread. Returns the build thread while one runs.
+    Unless ``force``, no build starts within BUILD_RETRY_SECONDS of one
+    that failed or found nothing to index."""
+    global _index, _build_thread
+    if not VECTOR_INDEX_ENABLED:
+        return None
+    with _index_lock:
+        if _index is not None or _build_thread is not None:
+            return _build_thread
+        if not force and time.monotonic() < _retry_at:
+            return None
+        index = VectorIndex(VECTOR_INDEX_DIR, _embedder or TfidfSvdEmbedder())
+        if index.load():
+            _index = index
+            return None
+        _build_thread = threading.Thread(target=_build_index, args=(index,),
+                                         name="vector-index-build", daemon=True)
+        _build_thread.start()
+        return _build_thread
+
+
+def get_index(wait: bool = False) -> Optional[VectorIndex]:
+    """The loaded index. If none exists yet it is built in the background
+    and None is returned meanwhile (BM25-only retrieval), unless ``wait``:
+    then a build is started even within the retry back-off and awaited."""
+    thread = start_index_build(force=wait)
+    if thread is not None and wait:
+        thread.join()
+    return _index
+
+
+def index_document(document_id: int) -> int:
+    """Embed and append the chunks of one newly ingested document.
+
+    Waits for a running build; chunks it already picked up are skipped.
+    """
+    index = get_index(wait=True)
+    if index is None:
+        return 0
+    return index.add_texts(iter_chunk_texts(document_id), skip_existing=True)
+
+
+def drop_chunks(chunk_ids: Iterable[int]) -> int:
+    """Remove the vectors of deleted chunks (e.g. a re-chunked document)."""
+    index = get_index(wait=True)
+    if index is None:
+        return 0
+    return index.remove(chunk_ids)
+
+
+def hybrid_search(question: str, limit: int = 5, candidates: int = VECTOR_CANDIDATES):
+    """BM25 + vector retrieval fused with reciprocal rank fusion.
+
+    Returns rows shaped like database.search_chunks, best first. Falls
+    back to BM25 alone if the vector index is unavailable.
+    """
+    bm25_rows = search_chunks(question, limit=max(limit, candidates))
+    try:
+        index = get_index()
+        vector_hits = index.query(question, candidates) if index else []
+    except Exception:
+        logger.exception("Vector search failed, using BM25 only")
+        vector_hits = []
+    if not vector_hits:
+        return bm25_rows[:limit]
+
+    fused = {}
+    for rank, row in enumerate(bm25_rows):
+        fused[row["chunk_id"]] = fused.get(row["chunk_id"], 0.0) + 1.0 / (HYBRID_RRF_K + rank + 1)
+    for rank, (chunk_id, _) in enumerate(vector_hits):
+        fused[chunk_id] = fused.get(chunk_id, 0.0) + 1.0 / (HYBRID_RRF_K + rank + 1)
+
+    ranked = sorted(fused, key=fused.get, reverse=True)[:limit]
+    by_id = {row["chunk_id"]: row for row in bm25_rows}
+    missing = [i for i in ranked if i not in by_id]
+    for row in get_chunks_by_ids(missing):
+        by_id[row["chunk_id"]] = row
+    return [by_id[i] for i in ranked if i in by_id]
+
+
+# ==========================================================
+# BENCHMARK
+# ==========================================================
+def _bench(sizes: List[int], dim: int, k: int, queries: int):
+    rng = np.random.default_rng(0)
+    print(f"dim={dim} k={k} queries={queries}")
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as folder:
+            emb = Embedder()
+            emb.dim = dim
+            index = VectorIndex(folder, emb)
+            for start in range(0, n, 100000):
+                rows = min(100000, n - start)
+                vecs = rng.standard_normal((rows, dim), dtype=np.float32)
+                vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
+                index.append(list(range(start, start + rows)), vecs)
+            qs = rng.standard_normal((queries, dim), dtype=np.float32)
+            index.search(qs[0], k)   # warm the page cache
+            times = []
+            for q in qs:
+                t = time.perf_counter()
+                index.search(q, k)
+                times.append((time.perf_counter() - t) * 1000)
+            times.sort()
+            print(f"{n:>9} chunks: p50 {times[len(times) // 2]:8.2f} ms   "
+                  f"p95 {times[int(len(times) * 0.95) - 1]:8.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Vector index tools")
+    parser.add_argument("--bench", action="store_true", help="query latency benchmark")
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--dim", type=int, default=VECTOR_DIM)
+    parser.add_argument("--k", type=int, default=VECTOR_CANDIDATES)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--rebuild", action="store_true", help="rebuild from the DB")
+    args = parser.parse_args()
+
+    if args.bench:
+        _bench([int(s) for s in args.sizes.split(",")], args.dim, args.k, args.queries)
+    elif args.rebuild:
+        logging.basicConfig(level=logging.INFO)
+        index = VectorIndex(VECTOR_INDEX_DIR, TfidfSvdEmbedder())
+        added = index.rebuild(iter_chunk_texts, sample_chunk_texts(index.embedder.fit_sample))
+        print(f"Indexed {added} chunks")
+    else:
+        parser.print_help()